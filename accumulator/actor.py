@@ -24,6 +24,11 @@ class AccumulatorActor(Actor, AccumulatorInterface):
             self.tree_counter += 1
             self.meta_counter += 1
 
+    async def meta_add_many(self, n: int):
+        async with self.locker.writer_lock:
+            self.tree_counter += n
+            self.meta_counter += n
+
     async def get(self) -> Dict[str, int]:
         async with self.locker.reader_lock:
             return {"tree": self.tree_counter, "meta": self.meta_counter}
@@ -1,84 +1,78 @@
-import asyncio
+import json
 import time
 import traceback
-from queue import Queue
-from typing import List, Tuple, Set
-
-from aiologger import Logger
-from aiologger.formatters.base import Formatter
-from aiologger.levels import LogLevel
-from dacite import from_dict
-from dapr.actor import ActorProxy, ActorId
-from dapr.ext.fastapi import DaprApp
+import uuid
+from datetime import timedelta
+from typing import List, Tuple
+
+import numpy as np
+from dapr.actor import ActorProxy, ActorId, ActorRuntime
+from dapr.actor.runtime.config import ActorRuntimeConfig, ActorReentrancyConfig
+from dapr.ext.fastapi import DaprApp, DaprActor
 from fastapi import FastAPI, HTTPException
-from pyproj import Transformer
-from shapely.geometry import LineString, Polygon
-from split import chop
-
-from index.actor import DistributedIndexActor
-from interfaces.distance_compute_interface import DistanceComputeInterface
-from interfaces.distributed_index_interface import DistributedIndexInterface
-from interfaces.index_meta_interface import IndexMetaInterface
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from shapely.geometry import Polygon
+
+from agent.pipeline import logger, track_areas, locate_regions, probe_regions
+from agent.scheduler import schedule, dispatch
+from agent.standing import StandingQueryActor
+from interfaces.packed import from_wire, unpack_trajectory
+from interfaces.standing_query_interface import StandingQueryInterface
 from interfaces.trajectory_assembler_interface import TrajectoryAssemblerInterface
-from interfaces.types import TrajectoryPoint
 
 app = FastAPI(title=f'Continuous query agent Service')
 
 dapr = DaprApp(app)
 
-transformer = Transformer.from_crs(4326, 3857, always_xy=True)
+ActorRuntime.set_actor_config(
+    ActorRuntimeConfig(
+        actor_idle_timeout=timedelta(hours=30),
+        actor_scan_interval=timedelta(hours=1),
+        drain_ongoing_call_timeout=timedelta(minutes=2),
+        drain_rebalanced_actors=True,
+        reentrancy=ActorReentrancyConfig(enabled=False),
+    )
+)
+
+# 持续查询actor由本服务承载
+actor = DaprActor(app)
+
 
-logger = Logger.with_default_handlers(name=f"Query agent", level=LogLevel.INFO,
-                                      formatter=Formatter("%(name)s-%(asctime)s: %(message)s"))
+@app.on_event("startup")
+async def startup_event():
+    await actor.register_actor(StandingQueryActor)
 
 
 @app.get("/query-with-id/{target_trajectory_id}")
-async def query_with_id(target_trajectory_id: str, threshold: float, batch_size=3):
+async def query_with_id(target_trajectory_id: str, threshold: float):
     try:
         # 拿到轨迹所有的点
         before_target = time.perf_counter()
         target_home = ActorProxy.create('TrajectoryAssemblerActor', ActorId(target_trajectory_id),
                                         TrajectoryAssemblerInterface)
-        target: List[TrajectoryPoint] = [from_dict(TrajectoryPoint, i) for i in await target_home.Query()]
-        points: List[Tuple[float, float]] = [transformer.transform(i.lng, i.lat) for i in target]
-        # 组成复合polygon
-        areas: Polygon = LineString(points).buffer(threshold)
+        target, _ = unpack_trajectory(from_wire(await target_home.QueryPacked()))
+        areas: Polygon = track_areas(target, threshold)
         after_target = time.perf_counter()
         await logger.info(f"target: {after_target - before_target}s, areas: {areas.wkt}")
         # 送meta查询rtree
         before_query = time.perf_counter()
-        meta_proxy = ActorProxy.create('IndexMetaActor', ActorId("0"), IndexMetaInterface)
-        candidate_regions: List[str] = await meta_proxy.AgentQuery(areas.wkt)
+        candidate_regions: List[str] = await locate_regions(areas)
         after_query = time.perf_counter()
         await logger.info(f"regions time:{after_query - before_query}s,  regions: {candidate_regions}")
         # 根据meta返回的index id调用query取得候选轨迹id
         before_candidate = time.perf_counter()
-        candidates_ids = set()
-        q = Queue()
-        [q.put(c) for c in candidate_regions]
-        while not q.empty():
-            r = q.get()
-            candidate_region_proxy = ActorProxy.create('DistributedIndexActor', ActorId(r), DistributedIndexInterface)
-            has_value, partial_candidates = await candidate_region_proxy.Query(areas.wkt)
-            if has_value:
-                candidates_ids.update(partial_candidates)
-            else:
-                await logger.info(f"Failed, adding more cells")
-                more_cells: Set[str] = DistributedIndexActor.split_h3_area(r, partial_candidates[0])
-                [q.put(c) for c in more_cells]
+        candidates_ids = await probe_regions(candidate_regions, areas.wkt)
         after_candidate = time.perf_counter()
         await logger.info(f"tid time: {after_candidate - before_candidate}s, tids: {candidates_ids}")
-        # 发送compute计算距离
+        # 按估计代价划分工作单元，交给有限数量的compute计算距离
         before_compute = time.perf_counter()
-        coroutines = []
-        # res=[]
-        for idx, c in enumerate(chop(int(batch_size), candidates_ids)):
-            compute_proxy = ActorProxy.create("DistanceComputeActor", ActorId(str(idx)), DistanceComputeInterface)
-            coroutines.append(compute_proxy.ComputeHausdorffWithID({
-                "target_trajectory_id": target_trajectory_id,
-                "candidates": c
-            }))
-        res = await asyncio.gather(*coroutines)
+        units = schedule(candidates_ids, len(target))
+        res = [partial async for partial in dispatch(units, lambda proxy, unit: proxy.ComputeHausdorffWithID({
+            "target_trajectory_id": target_trajectory_id,
+            "candidates": unit,
+            "threshold": float(threshold)
+        }))]
         after_compute = time.perf_counter()
         await logger.info(
             f"compute: {after_compute - before_compute}s, total: {after_compute - before_target}s")
@@ -96,6 +90,95 @@ async def query_with_id(target_trajectory_id: str, threshold: float, batch_size=
         raise HTTPException(500, str(e))
 
 
+class TrackQuery(BaseModel):
+    # (lng, lat)点序列
+    track: List[Tuple[float, float]]
+    threshold: float
+
+
 @app.post("/query-with-track")
-async def query_with_track():
-    pass
+async def query_with_track(query: TrackQuery):
+    """
+    对任意给定的轨迹查询相似轨迹，每个工作单元完成后立即以NDJSON逐行返回，最后一行为各阶段耗时
+    """
+    if len(query.track) < 2:
+        raise HTTPException(400, "track needs at least 2 points")
+    try:
+        before_target = time.perf_counter()
+        target = np.asarray(query.track, dtype=np.float64)
+        areas: Polygon = track_areas(target, query.threshold)
+        after_target = time.perf_counter()
+        before_query = time.perf_counter()
+        candidate_regions: List[str] = await locate_regions(areas)
+        after_query = time.perf_counter()
+        await logger.info(f"regions time:{after_query - before_query}s,  regions: {candidate_regions}")
+        before_candidate = time.perf_counter()
+        candidates_ids = await probe_regions(candidate_regions, areas.wkt)
+        after_candidate = time.perf_counter()
+        await logger.info(f"tid time: {after_candidate - before_candidate}s, tids: {candidates_ids}")
+        units = schedule(candidates_ids, len(target))
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(500, str(e))
+
+    async def stream():
+        before_compute = time.perf_counter()
+        results = dispatch(units, lambda proxy, unit: proxy.ComputeHausdorffWithProvidedTrack({
+            "target_trajectory": query.track,
+            "candidates": unit,
+            "threshold": query.threshold
+        }))
+        try:
+            async for partial in results:
+                yield json.dumps({"res": partial, "time": time.time()}) + "\n"
+            after_compute = time.perf_counter()
+            await logger.info(
+                f"compute: {after_compute - before_compute}s, total: {after_compute - before_target}s")
+            yield json.dumps({
+                "target": after_target - before_target,
+                "regions": after_query - before_query,
+                "tid": after_candidate - before_candidate,
+                "compute": after_compute - before_compute,
+                "time": time.time()
+            }) + "\n"
+        except Exception as e:
+            traceback.print_exc()
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            # 客户端中途断开时不再等待剩余单元
+            await results.aclose()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+class StandingQuery(BaseModel):
+    target_trajectory_id: str
+    threshold: float
+
+
+@app.post("/standing-query")
+async def register_standing_query(query: StandingQuery):
+    """
+    登记持续查询，结果变化推送到standing-query主题，也可随时查询当前结果
+    """
+    query_id = uuid.uuid4().hex
+    proxy = ActorProxy.create('StandingQueryActor', ActorId(query_id), StandingQueryInterface)
+    await proxy.Register(query.dict())
+    return {"id": query_id}
+
+
+@app.get("/standing-query/{query_id}")
+async def standing_query_result(query_id: str):
+    proxy = ActorProxy.create('StandingQueryActor', ActorId(query_id), StandingQueryInterface)
+    res: dict = await proxy.Result()
+    if res["query"] is None:
+        raise HTTPException(404, f"{query_id} is not registered")
+    return res
+
+
+@app.delete("/standing-query/{query_id}")
+async def unregister_standing_query(query_id: str):
+    proxy = ActorProxy.create('StandingQueryActor', ActorId(query_id), StandingQueryInterface)
+    if not await proxy.Unregister():
+        raise HTTPException(404, f"{query_id} is not registered")
+    return {"id": query_id}
@@ -0,0 +1,90 @@
+import asyncio
+import json
+from collections import defaultdict
+from itertools import chain
+from typing import Dict, List, Tuple, Set, Iterable, Union
+
+import numpy as np
+from aiologger import Logger
+from aiologger.formatters.base import Formatter
+from aiologger.levels import LogLevel
+from dapr.actor import ActorProxy, ActorId
+from pyproj import Transformer
+from shapely.geometry import LineString, Polygon
+
+from index.actor import DistributedIndexActor
+from index_meta.shard import meta_proxy, polygon_shards
+from interfaces.distributed_index_interface import DistributedIndexInterface
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 候选阶段同时查询的索引分区数量
+    AGENT_PROBE_CONCURRENCY = para.get("AGENT_PROBE_CONCURRENCY", 16)
+
+print(f"{AGENT_PROBE_CONCURRENCY=}", flush=True)
+
+transformer = Transformer.from_crs(4326, 3857, always_xy=True)
+
+logger = Logger.with_default_handlers(name=f"Query agent", level=LogLevel.INFO,
+                                      formatter=Formatter("%(name)s-%(asctime)s: %(message)s"))
+
+
+def track_areas(target: np.ndarray, threshold: float) -> Polygon:
+    """
+    轨迹投影到墨卡托平面后按阈值缓冲成查询范围
+    """
+    xs, ys = transformer.transform(target[:, 0], target[:, 1])
+    points: List[Tuple[float, float]] = list(zip(xs, ys))
+    # 组成复合polygon
+    return LineString(points).buffer(threshold)
+
+
+async def locate_regions(areas: Polygon) -> List[str]:
+    """
+    查询范围可能跨越多个协调者分片，分散查询再合并
+    """
+    shard_regions: List[List[str]] = await asyncio.gather(
+        *[meta_proxy(shard).AgentQuery(areas.wkt) for shard in polygon_shards(areas)])
+    return list(set(chain.from_iterable(shard_regions)))
+
+
+async def probe_regions(regions: List[str], wkt_string: str) -> Dict[str, int]:
+    """
+    有限并发地向各分区查询候选轨迹id，已分裂的分区改查子分区，任一查询出错则取消其余查询
+
+    返回各候选在所查分区中的线段数之和，作为其轨迹长度的估计
+    """
+    semaphore = asyncio.Semaphore(AGENT_PROBE_CONCURRENCY)
+    visited: Set[str] = set()
+    pending: Set[asyncio.Task] = set()
+    candidates_ids: Dict[str, int] = defaultdict(int)
+
+    async def probe(r: str) -> Tuple[str, bool, Union[Dict[str, int], list]]:
+        async with semaphore:
+            candidate_region_proxy = ActorProxy.create('DistributedIndexActor', ActorId(r), DistributedIndexInterface)
+            has_value, partial_candidates = await candidate_region_proxy.QueryWithCounts(wkt_string)
+            return r, has_value, partial_candidates
+
+    def submit(cells: Iterable[str]) -> None:
+        for c in cells:
+            if c not in visited:
+                visited.add(c)
+                pending.add(asyncio.create_task(probe(c)))
+
+    submit(regions)
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            for task in done:
+                r, has_value, partial_candidates = task.result()
+                if has_value:
+                    for c, n in partial_candidates.items():
+                        candidates_ids[c] += n
+                else:
+                    await logger.info(f"Failed, adding more cells")
+                    submit(DistributedIndexActor.split_h3_area(r, partial_candidates[0]))
+    finally:
+        for task in pending:
+            task.cancel()
+    return dict(candidates_ids)
@@ -0,0 +1,85 @@
+import asyncio
+import json
+from typing import List, Dict, Callable, Awaitable, AsyncIterator
+
+from dapr.actor import ActorProxy, ActorId
+
+from interfaces.distance_compute_interface import DistanceComputeInterface
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 一次查询最多同时使用的计算actor数量
+    COMPUTE_POOL_SIZE = para.get("COMPUTE_POOL_SIZE", 16)
+    # 每个工作单元的估计代价上限，代价为候选点数乘以目标轨迹点数
+    COMPUTE_UNIT_COST = para.get("COMPUTE_UNIT_COST", 4_000_000)
+    # 每个计算actor平均分到的单元数，单元越多负载越均衡，调用次数也越多
+    UNITS_PER_ACTOR = para.get("UNITS_PER_ACTOR", 4)
+
+print(f"{COMPUTE_POOL_SIZE=}", flush=True)
+print(f"{COMPUTE_UNIT_COST=}", flush=True)
+print(f"{UNITS_PER_ACTOR=}", flush=True)
+
+
+def plan_units(lengths: Dict[str, int], target_length: int, unit_cost: int = COMPUTE_UNIT_COST) -> List[List[str]]:
+    """
+    按估计代价从大到小把候选装入工作单元，每个单元的代价不超过unit_cost，超出上限的单个候选独占一个单元
+
+    代价大的单元排在前面，最先开始计算，避免最后剩下一个大单元拖长整体耗时
+    """
+    units: List[List[str]] = []
+    cost = 0
+    for c in sorted(lengths, key=lambda x: lengths[x], reverse=True):
+        c_cost = max(lengths[c], 1) * max(target_length, 1)
+        if not units or cost + c_cost > unit_cost:
+            units.append([])
+            cost = 0
+        units[-1].append(c)
+        cost += c_cost
+    return units
+
+
+def schedule(lengths: Dict[str, int], target_length: int) -> List[List[str]]:
+    """
+    lengths为各候选轨迹长度的估计，取自索引查询时返回的线段数，无需另行询问各轨迹；
+    候选不多于计算actor数量时每个候选单独成为一个单元，小查询缩小单元代价，使每个计算actor都能分到若干单元
+    """
+    if len(lengths) <= COMPUTE_POOL_SIZE:
+        return [[c] for c in lengths]
+    total = sum(max(n, 1) for n in lengths.values()) * max(target_length, 1)
+    unit_cost = min(COMPUTE_UNIT_COST, -(-total // (COMPUTE_POOL_SIZE * UNITS_PER_ACTOR)))
+    return plan_units(lengths, target_length, unit_cost)
+
+
+async def dispatch(units: List[List[str]],
+                   compute: Callable[[DistanceComputeInterface, List[str]], Awaitable[Dict[str, float]]]
+                   ) -> AsyncIterator[Dict[str, float]]:
+    """
+    固定数量的计算actor各自完成一个单元后再领取下一个，按完成顺序返回各单元的结果
+
+    所在副本繁忙的actor完成得慢，领取的单元也就少，负载随之均衡
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    for unit in units:
+        queue.put_nowait(unit)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def worker(idx: int) -> None:
+        proxy = ActorProxy.create("DistanceComputeActor", ActorId(str(idx)), DistanceComputeInterface)
+        while not queue.empty():
+            unit = queue.get_nowait()
+            try:
+                results.put_nowait(await compute(proxy, unit))
+            except Exception as e:
+                results.put_nowait(e)
+
+    workers = [asyncio.ensure_future(worker(idx)) for idx in range(min(COMPUTE_POOL_SIZE, len(units)))]
+    try:
+        for _ in units:
+            res = await results.get()
+            if isinstance(res, Exception):
+                raise res
+            yield res
+    finally:
+        # 出错或调用方中途放弃时不再等待剩余单元
+        for w in workers:
+            w.cancel()
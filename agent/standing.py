@@ -0,0 +1,226 @@
+import asyncio
+import json
+import traceback
+from datetime import timedelta
+from typing import Optional, Dict, Set, List
+
+from aiologger import Logger
+from aiologger.formatters.base import Formatter
+from aiologger.levels import LogLevel
+from dapr.actor import Actor, ActorId, ActorProxy
+from dapr.actor.runtime.context import ActorRuntimeContext
+from dapr.clients import DaprClient
+
+from agent.pipeline import track_areas, locate_regions, probe_regions
+from agent.scheduler import schedule, dispatch
+from interfaces.distributed_index_interface import DistributedIndexInterface
+from interfaces.packed import from_wire, unpack_trajectory
+from interfaces.standing_query_interface import StandingQueryInterface
+from interfaces.trajectory_assembler_interface import TrajectoryAssemblerInterface
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 持续查询两次重新计算之间的最短间隔（秒），期间的变化合并处理
+    STANDING_QUERY_INTERVAL = para.get("STANDING_QUERY_INTERVAL", 5)
+    # 推送结果变化的pubsub组件
+    STANDING_QUERY_PUBSUB = para.get("STANDING_QUERY_PUBSUB", "pubsub")
+
+print(f"{STANDING_QUERY_INTERVAL=}", flush=True)
+print(f"{STANDING_QUERY_PUBSUB=}", flush=True)
+
+STANDING_QUERY_TOPIC = "standing-query"
+
+
+def publish(data: dict) -> None:
+    with DaprClient() as client:
+        client.publish_event(pubsub_name=STANDING_QUERY_PUBSUB, topic_name=STANDING_QUERY_TOPIC,
+                             data=json.dumps(data), data_content_type="application/json")
+
+
+class StandingQueryActor(Actor, StandingQueryInterface):
+    """
+    持续相似轨迹查询：订阅查询范围内的索引分区与结果中的轨迹，只重新计算受影响的候选并推送结果变化
+    """
+
+    def __init__(self, ctx: ActorRuntimeContext, actor_id: ActorId):
+        super().__init__(ctx, actor_id)
+        self.STATE_KEY = f"StandingQuery_{self.id.id}"
+
+        # target_trajectory_id, threshold
+        self.query: Optional[dict] = None
+        self.results: Dict[str, float] = {}
+        self.version: int = 0
+        # 已订阅的索引分区与已关注的轨迹
+        self.regions: Set[str] = set()
+        self.watched: Set[str] = set()
+        # 待重新计算的候选，目标轨迹变化时需要整体刷新
+        self.dirty: Set[str] = set()
+        self.refresh: bool = False
+        # 上一次整体刷新时的目标轨迹长度与各候选的长度估计，用于估计计算代价
+        self.target_length: int = 1
+        self.lengths: Dict[str, int] = {}
+
+        self.logger = Logger.with_default_handlers(name=f"StandingQuery_{self.id.id}", level=LogLevel.INFO,
+                                                   formatter=Formatter("%(name)s-%(asctime)s: %(message)s"))
+
+    async def _on_activate(self) -> None:
+        has_value, p = await self._state_manager.try_get_state(self.STATE_KEY)
+        if has_value:
+            self.query = p["query"]
+            self.results = p["results"]
+            self.version = p["version"]
+            self.regions = set(p["regions"])
+            self.watched = set(p["watched"])
+            # 停用期间可能错过了通知
+            self.refresh = True
+            await self._start()
+
+    async def _on_deactivate(self) -> None:
+        await self.logger.info("Deactivated")
+        await self.logger.shutdown()
+
+    async def _start(self) -> None:
+        await self.register_timer("reevaluate", self._reevaluate, None, timedelta(seconds=0),
+                                  timedelta(seconds=STANDING_QUERY_INTERVAL))
+
+    async def _save(self) -> None:
+        await self._state_manager.set_state(self.STATE_KEY, {
+            "query": self.query,
+            "results": self.results,
+            "version": self.version,
+            "regions": list(self.regions),
+            "watched": list(self.watched)
+        })
+
+    async def register(self, data: dict) -> bool:
+        if self.query is not None:
+            await self.unregister()
+        self.query = {
+            "target_trajectory_id": data["target_trajectory_id"],
+            "threshold": float(data["threshold"])
+        }
+        self.refresh = True
+        await self._save()
+        await self._start()
+        return True
+
+    async def unregister(self) -> bool:
+        if self.query is None:
+            return False
+        await self.unregister_timer("reevaluate")
+        await self._subscribe(set(), "")
+        await self._watch(set())
+        await self._state_manager.remove_state(self.STATE_KEY)
+        self.query = None
+        self.results = {}
+        self.dirty = set()
+        return True
+
+    async def notify(self, data: dict) -> bool:
+        """
+        记下发生变化的轨迹，等到下一次定时重新计算；分区分裂时同时记下转交了订阅的子分区
+        """
+        if self.query is None:
+            return False
+        regions: List[str] = data.get("regions", [])
+        if not self.regions.issuperset(regions):
+            self.regions.update(regions)
+            await self._save()
+        trajectories: List[str] = data["trajectories"]
+        if self.query["target_trajectory_id"] in trajectories:
+            self.refresh = True
+        self.dirty.update(trajectories)
+        return True
+
+    async def result(self) -> dict:
+        return {
+            "query": self.query,
+            "version": self.version,
+            "results": self.results
+        }
+
+    async def _subscribe(self, regions: Set[str], wkt_string: str) -> None:
+        """
+        订阅范围内的分区，退订不再相交的分区
+        """
+        def proxy(r: str):
+            return ActorProxy.create('DistributedIndexActor', ActorId(r), DistributedIndexInterface)
+
+        await asyncio.gather(*[proxy(r).Subscribe({"query": self.id.id, "wkt": wkt_string}) for r in regions],
+                             *[proxy(r).Unsubscribe(self.id.id) for r in self.regions - regions])
+        self.regions = regions
+
+    async def _watch(self, trajectories: Set[str]) -> None:
+        def proxy(t: str):
+            return ActorProxy.create('TrajectoryAssemblerActor', ActorId(t), TrajectoryAssemblerInterface)
+
+        await asyncio.gather(*[proxy(t).Watch({"query": self.id.id, "watch": True})
+                               for t in trajectories - self.watched],
+                             *[proxy(t).Watch({"query": self.id.id, "watch": False})
+                               for t in self.watched - trajectories])
+        self.watched = trajectories
+
+    async def _candidates(self) -> Set[str]:
+        """
+        按目标轨迹重新计算查询范围，更新分区订阅并返回范围内的全部候选，同时记下各候选的长度估计
+        """
+        target_home = ActorProxy.create('TrajectoryAssemblerActor', ActorId(self.query["target_trajectory_id"]),
+                                        TrajectoryAssemblerInterface)
+        target, _ = unpack_trajectory(from_wire(await target_home.QueryPacked()))
+        self.target_length = len(target)
+        if len(target) < 2:
+            return set()
+        areas = track_areas(target, self.query["threshold"])
+        regions = set(await locate_regions(areas))
+        self.lengths = await probe_regions(list(regions), areas.wkt)
+        await self._subscribe(regions, areas.wkt)
+        return set(self.lengths)
+
+    async def _compute(self, candidates: Set[str]) -> Dict[str, float]:
+        # 范围外新加入的候选没有长度估计，按已知候选的平均长度计
+        default = sum(self.lengths.values()) // len(self.lengths) if self.lengths else 1
+        units = schedule({c: self.lengths.get(c, default) for c in candidates}, self.target_length)
+        res: Dict[str, float] = {}
+        async for partial in dispatch(units, lambda proxy, unit: proxy.ComputeHausdorffWithID({
+            "target_trajectory_id": self.query["target_trajectory_id"],
+            "candidates": unit,
+            "threshold": self.query["threshold"]
+        })):
+            res.update(partial)
+        return res
+
+    async def _reevaluate(self, _) -> None:
+        """
+        定时合并期间的变化：目标轨迹变化时整体刷新，否则只重新计算发生变化的候选
+        """
+        if self.query is None or not (self.refresh or self.dirty):
+            return
+        refresh, dirty = self.refresh, self.dirty
+        self.refresh, self.dirty = False, set()
+        try:
+            if refresh:
+                candidates = await self._candidates() | set(self.results)
+            else:
+                candidates = dirty
+            distances = await self._compute(candidates)
+            changed = {c: d for c, d in distances.items() if self.results.get(c) != d}
+            removed = [c for c in candidates if c in self.results and c not in distances]
+            if changed or removed:
+                self.results.update(changed)
+                for c in removed:
+                    del self.results[c]
+                self.version += 1
+                await asyncio.get_running_loop().run_in_executor(None, publish, {
+                    "id": self.id.id,
+                    "version": self.version,
+                    "changed": changed,
+                    "removed": removed
+                })
+            await self._watch(set(self.results) | {self.query["target_trajectory_id"]})
+            await self._save()
+        except Exception as e:
+            traceback.print_exc()
+            await self.logger.warning(f"Reevaluation failed: {e}")
+            # 下一次定时重试
+            self.refresh = self.refresh or refresh
+            self.dirty.update(dirty)
@@ -1,66 +1,138 @@
 import asyncio
+import json
 import traceback
-from asyncio import Queue
+from collections import defaultdict
 from dataclasses import asdict
-from typing import List, Optional, Tuple, Set
+from typing import List, Optional, Tuple, Set, Dict
 
 import h3
 from aiologger import Logger
 from aiologger.formatters.base import Formatter
 from aiologger.levels import LogLevel
-from dacite import from_dict
 from dapr.actor import Actor, ActorProxy
 from dapr.actor.id import ActorId
 from dapr.actor.runtime.context import ActorRuntimeContext
 
 from interfaces.distributed_index_interface import DistributedIndexInterface
-from interfaces.index_meta_interface import IndexMetaInterface
+from assemble.routing import RegionRoutingCache
+from assemble.trajectory import ColumnarTrajectory
+from index_meta.shard import meta_proxy, point_shard
+from interfaces.codec import points_from_wire, points_to_wire, segments_to_wire
+from interfaces.notify import notify_standing_queries
+from interfaces.packed import to_wire
 from interfaces.trajectory_assembler_interface import TrajectoryAssemblerInterface
 from interfaces.types import TrajectoryPoint, TrajectorySegment
 
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 每个轨迹状态分块存储的轨迹点数量
+    TRAJECTORY_CHUNK_SIZE = para.get("TRAJECTORY_CHUNK_SIZE", 128)
+    # 路由缓存的网格分辨率，同一网格内的点视为落在相同分区
+    ROUTING_CACHE_RESOLUTION = para.get("ROUTING_CACHE_RESOLUTION", 10)
+    # 路由缓存的最大网格数，0为关闭缓存
+    ROUTING_CACHE_SIZE = para.get("ROUTING_CACHE_SIZE", 100000)
+    # 进程内同时向索引分区发送的最大请求数
+    ROUTING_CONCURRENCY = para.get("ROUTING_CONCURRENCY", 32)
+    # 分区返回错误时对同一分区的最大重试次数
+    ROUTING_MAX_RETRIES = para.get("ROUTING_MAX_RETRIES", 3)
+
+print(f"{TRAJECTORY_CHUNK_SIZE=}", flush=True)
+print(f"{ROUTING_CACHE_RESOLUTION=}", flush=True)
+print(f"{ROUTING_CACHE_SIZE=}", flush=True)
+print(f"{ROUTING_CONCURRENCY=}", flush=True)
+print(f"{ROUTING_MAX_RETRIES=}", flush=True)
+
+# 同一进程内所有assembler共享
+ROUTING_CACHE = RegionRoutingCache(ROUTING_CACHE_RESOLUTION, ROUTING_CACHE_SIZE)
+_dispatch_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def dispatch_semaphore() -> asyncio.Semaphore:
+    """
+    延迟创建，保证绑定到服务实际运行的事件循环
+    """
+    global _dispatch_semaphore
+    if _dispatch_semaphore is None:
+        _dispatch_semaphore = asyncio.Semaphore(ROUTING_CONCURRENCY)
+    return _dispatch_semaphore
+
 
 class TrajectoryAssemblerActor(Actor, TrajectoryAssemblerInterface):
     def __init__(self, ctx: ActorRuntimeContext, actor_id: ActorId):
         super().__init__(ctx, actor_id)
         self.PREVIOUS_POINT_STATE_KEY = f"previous_point_{self.id.id}"
         self.TRAJECTORY_STATE_KEY = f"trajectory_{self.id.id}"
+        self.TRAJECTORY_MANIFEST_KEY = f"trajectory_{self.id.id}_manifest"
+        self.WATCHERS_KEY = f"trajectory_{self.id.id}_watchers"
 
         self.previous_point: Optional[TrajectoryPoint] = None
-        self.trajectory: Optional[List[TrajectoryPoint]] = None
+        # 完整轨迹只在查询时才从分块中懒加载
+        self.trajectory: Optional[ColumnarTrajectory] = None
+        self.trajectory_length: int = 0
+        self.chunk_size: int = TRAJECTORY_CHUNK_SIZE
+        # 尾部分块，追加新点时只改写这一块
+        self.tail_chunk: List[TrajectoryPoint] = []
+        # 关注本轨迹变化的持续查询
+        self.watchers: Set[str] = set()
         self.logger = Logger.with_default_handlers(name=f"{self.__class__.__name__}_{self.id.id}", level=LogLevel.INFO,
                                                    formatter=Formatter("%(name)s-%(asctime)s: %(message)s"))
 
     async def query(self) -> List[dict]:
-        return list(map(asdict, self.trajectory))
+        return list(map(asdict, (await self._load_trajectory()).points()))
+
+    async def query_packed(self) -> str:
+        return to_wire((await self._load_trajectory()).pack())
+
+    async def query_packed_from(self, offset: int) -> dict:
+        """
+        只返回第offset个点之后新增的点，调用方已持有前offset个点；offset超出轨迹长度时返回整条轨迹
+        """
+        if offset > self.trajectory_length:
+            offset = 0
+        points = b"" if offset == self.trajectory_length else (await self._load_trajectory()).pack(offset)
+        return {"offset": offset, "length": self.trajectory_length, "points": to_wire(points)}
+
+    async def length(self) -> int:
+        return self.trajectory_length
 
     async def accept_new_point(self, p: dict) -> bool:
+        return await self.accept_new_points([p])
+
+    async def accept_new_points(self, points: List[dict]) -> bool:
+        return await self._accept(points_from_wire(points))
+
+    async def accept_packed_points(self, data: str) -> bool:
+        return await self._accept(points_from_wire(data))
+
+    async def _accept(self, points: List[TrajectoryPoint]) -> bool:
+        """
+        接受同一轨迹的一批连续轨迹点，一次性组装成线段并发送至索引
+        """
         try:
-            if self.previous_point:
-                p: TrajectoryPoint = from_dict(TrajectoryPoint, p)
-                prev = self.previous_point
-                dis = h3.point_dist((p.lat, p.lng), (prev.lat, prev.lng), unit='km')
-                if dis > 100:
-                    # 怪异错误点，直接剔除
-                    return True
-                # 发送到index模块
-                # try:
-                data = {
-                    "start": asdict(prev),
-                    "end": asdict(p)
-                }
-
-                await self._send_to_regions(data, prev, p)
-                # 发送可能会出错，因此本地状态更新最后做以保证重试正确性
-                t = self.trajectory
-                t.append(p)
-                await self._save_previous_point(p)
-                await self._save_trajectory(t)
-                return True
-            else:
-                p: TrajectoryPoint = from_dict(TrajectoryPoint, p)
-                await self._save_previous_point(p)
-                await self._save_trajectory([p])
+            prev: Optional[TrajectoryPoint] = self.previous_point
+            accepted: List[TrajectoryPoint] = []
+            segments: List[Tuple[TrajectoryPoint, TrajectoryPoint]] = []
+            for p in points:
+                if prev:
+                    dis = h3.point_dist((p.lat, p.lng), (prev.lat, prev.lng), unit='km')
+                    if dis > 100:
+                        # 怪异错误点，直接剔除
+                        continue
+                    segments.append((prev, p))
+                accepted.append(p)
+                prev = p
+            if not accepted:
                 return True
+            # 发送到index模块，先整批查询各线段的路由，再并发发送各线段
+            if segments:
+                routes = await self._route(segments)
+                await asyncio.gather(*[self._send_to_regions(start, end, regions)
+                                       for (start, end), regions in zip(segments, routes)])
+            # 发送可能会出错，因此本地状态更新最后做以保证重试正确性
+            await self._save_previous_point(accepted[-1])
+            await self._append_trajectory(accepted)
+            notify_standing_queries(self.watchers, [self.id.id])
+            return True
         except asyncio.TimeoutError:
             print({"results": f"timeout error"}, flush=True)
             return False
@@ -69,38 +141,101 @@ class TrajectoryAssemblerActor(Actor, TrajectoryAssemblerInterface):
             print("error:", e, flush=True)
             return False
 
-    async def _send_to_regions(self, data, prev: TrajectoryPoint, p: TrajectoryPoint) -> None:
-        meta_proxy = ActorProxy.create('IndexMetaActor', ActorId("0"), IndexMetaInterface)
-        init_regions: List[str] = await meta_proxy.Query(data)
-        # coroutines = []
-        q: Queue[int] = Queue()
-        for r in init_regions:
-            proxy = ActorProxy.create('DistributedIndexActor', ActorId(r), DistributedIndexInterface)
-            # coroutines.append(proxy.AcceptNewSegment(asdict(TrajectorySegment(int(self.id.id), prev, p))))
-            res: Tuple[bool, int] = await proxy.AcceptNewSegment(asdict(TrajectorySegment(self.id.id, prev, p)))
-            if not res[0]:
-                await q.put(res[1])
-        while not q.empty():
-            resolution = await q.get()
-            target_regions: Set[str] = {
-                h3.geo_to_h3(prev.lat, prev.lng, resolution),
-                h3.geo_to_h3(p.lat, p.lng, resolution)
-            }
-            for r in target_regions:
-                await self.logger.warning(f"Retrying: {r},queue size:{q.qsize()}")
-                proxy = ActorProxy.create('DistributedIndexActor', ActorId(r), DistributedIndexInterface)
-                # coroutines.append(proxy.AcceptNewSegment(asdict(TrajectorySegment(int(self.id.id), prev, p))))
-                res: Tuple[bool, int] = await proxy.AcceptNewSegment(
-                    asdict(TrajectorySegment(self.id.id, prev, p)))
-                if not res[0]:
-                    await q.put(res[1])
-
-        # return await asyncio.gather(*coroutines)
+    @staticmethod
+    async def _route(segments: List[Tuple[TrajectoryPoint, TrajectoryPoint]]) -> List[Set[str]]:
+        """
+        先查本地路由缓存，端点未命中的线段再按端点所属分片整批询问协调者，返回每条线段要发往的分区
+        """
+        cells: List[Tuple[str, str]] = [(ROUTING_CACHE.cell(s.lng, s.lat), ROUTING_CACHE.cell(e.lng, e.lat))
+                                        for s, e in segments]
+        # 每条线段起点、终点所在的分区
+        routes: List[List[Optional[Tuple[str, ...]]]] = [
+            [ROUTING_CACHE.get(c, p.lng, p.lat) for c, p in zip(pair, segment)]
+            for pair, segment in zip(cells, segments)]
+        # 分片 -> 该分片负责端点未命中的线段下标
+        missing: Dict[str, List[int]] = defaultdict(list)
+        for i, (segment, found) in enumerate(zip(segments, routes)):
+            for shard in {point_shard(p.lng, p.lat) for p, r in zip(segment, found) if r is None}:
+                missing[shard].append(i)
+        replies: List[dict] = await asyncio.gather(*[meta_proxy(shard).QueryMany({
+            "segments": [[segments[i][0].lng, segments[i][0].lat, segments[i][1].lng, segments[i][1].lat]
+                         for i in batch],
+            "epoch": ROUTING_CACHE.epoch(shard)
+        }) for shard, batch in missing.items()])
+        for (shard, batch), reply in zip(missing.items(), replies):
+            if len(reply["segments"]) != len(batch):
+                raise RuntimeError(f"QueryMany answered {len(reply['segments'])} of {len(batch)} segments")
+            # 命中的条目即使在此被失效也照常使用，退役分区会在发送时重试
+            ROUTING_CACHE.apply(shard, reply)
+            for i, ends in zip(batch, reply["segments"]):
+                for k, indices in enumerate(ends):
+                    # 不归该分片负责的端点没有结果
+                    if indices:
+                        routes[i][k] = tuple(reply["regions"][j] for j in indices)
+                        ROUTING_CACHE.put(cells[i][k], list(routes[i][k]))
+        return [{*start, *end} for start, end in routes]
+
+    @staticmethod
+    async def _deliver(region: str, segment: str) -> Tuple[bool, int]:
+        async with dispatch_semaphore():
+            proxy = ActorProxy.create('DistributedIndexActor', ActorId(region), DistributedIndexInterface)
+            return await proxy.AcceptPackedSegment(segment)
+
+    async def _send_to_regions(self, prev: TrajectoryPoint, p: TrajectoryPoint, regions: Set[str]) -> None:
+        """
+        并发发送线段到整批路由得到的各分区，分区退役则改发子分区，每个分区至多成功接收一次
+        """
+        # 只编码一次，发往各分区共用
+        segment = segments_to_wire([TrajectorySegment(self.id.id, prev, p)])
+        # 已发送或正在发送的分区，并发的重试不会重复插入
+        delivered: Set[str] = set()
+        attempts: Dict[str, int] = defaultdict(int)
+        frontier: Set[str] = set(regions)
+        while frontier:
+            regions = list(frontier - delivered)
+            delivered.update(regions)
+            results: List[Tuple[bool, int]] = await asyncio.gather(
+                *[self._deliver(r, segment) for r in regions])
+            frontier = set()
+            for r, (ok, resolution) in zip(regions, results):
+                if ok:
+                    continue
+                if resolution > h3.h3_get_resolution(r):
+                    # 分区已分裂，改发端点所在的子分区，并让缓存指向子分区；
+                    # 同一网格内落在其他子分区的点在命中校验时视为未命中
+                    start_child = h3.geo_to_h3(prev.lat, prev.lng, resolution)
+                    end_child = h3.geo_to_h3(p.lat, p.lng, resolution)
+                    ROUTING_CACHE.retire(r, {
+                        ROUTING_CACHE.cell(prev.lng, prev.lat): start_child,
+                        ROUTING_CACHE.cell(p.lng, p.lat): end_child
+                    })
+                    frontier.update({start_child, end_child})
+                else:
+                    # 分区内部出错，有限次重试同一分区
+                    attempts[r] += 1
+                    if attempts[r] > ROUTING_MAX_RETRIES:
+                        raise RuntimeError(f"{r} rejected segment {attempts[r]} times")
+                    delivered.discard(r)
+                    frontier.add(r)
+            if frontier - delivered:
+                await self.logger.warning(f"Retrying: {frontier - delivered}")
+
+    async def watch(self, data: dict) -> bool:
+        """
+        持续查询关注或取消关注本轨迹
+        """
+        if data["watch"]:
+            self.watchers.add(data["query"])
+        else:
+            self.watchers.discard(data["query"])
+        await self._state_manager.set_state(self.WATCHERS_KEY, list(self.watchers))
+        return True
 
     async def _retrieve_previous_point(self) -> Optional[TrajectoryPoint]:
         has_value, p = await self._state_manager.try_get_state(self.PREVIOUS_POINT_STATE_KEY)
         if has_value:
-            val: TrajectoryPoint = from_dict(TrajectoryPoint, p)
+            # 旧版保存的是单个点的字典
+            val: TrajectoryPoint = points_from_wire(p if isinstance(p, str) else [p])[0]
             self.previous_point = val
             await self.logger.info("Got previous_point restored")
             return self.previous_point
@@ -110,30 +245,82 @@ class TrajectoryAssemblerActor(Actor, TrajectoryAssemblerInterface):
 
     async def _save_previous_point(self, p: TrajectoryPoint) -> None:
         self.previous_point = p
-        await self._state_manager.set_state(self.PREVIOUS_POINT_STATE_KEY, asdict(self.previous_point))
+        await self._state_manager.set_state(self.PREVIOUS_POINT_STATE_KEY, points_to_wire([self.previous_point]))
         # await self._state_manager.save_state()
 
-    async def _save_trajectory(self, t: List[TrajectoryPoint]) -> None:
+    def _chunk_key(self, k: int) -> str:
+        return f"{self.TRAJECTORY_STATE_KEY}_chunk_{k}"
+
+    async def _append_trajectory(self, points: List[TrajectoryPoint]) -> None:
         """
-        更新全局状态的轨迹信息
+        追加轨迹点，只改写受影响的尾部分块与清单
         """
-        self.trajectory = t
-        await self._state_manager.set_state(self.TRAJECTORY_STATE_KEY, list(map(asdict, self.trajectory)))
-        # await self._state_manager.save_state()
+        if self.trajectory is not None:
+            self.trajectory.extend(points)
+        tail_index = self.trajectory_length // self.chunk_size
+        tail = self.tail_chunk if len(self.tail_chunk) < self.chunk_size else []
+        for p in points:
+            if len(tail) == self.chunk_size:
+                await self._state_manager.set_state(self._chunk_key(tail_index), points_to_wire(tail))
+                tail_index += 1
+                tail = []
+            tail.append(p)
+        await self._state_manager.set_state(self._chunk_key(tail_index), points_to_wire(tail))
+        self.tail_chunk = tail
+        self.trajectory_length += len(points)
+        await self._state_manager.set_state(self.TRAJECTORY_MANIFEST_KEY, {
+            "chunk_size": self.chunk_size,
+            "length": self.trajectory_length
+        })
 
-    async def _retrieve_trajectory(self) -> Optional[List[TrajectoryPoint]]:
+    async def _retrieve_chunk(self, k: int) -> List[TrajectoryPoint]:
+        has_value, val = await self._state_manager.try_get_state(self._chunk_key(k))
+        return points_from_wire(val) if has_value else []
+
+    async def _load_trajectory(self) -> ColumnarTrajectory:
+        """
+        按清单把各分块重新拼装成完整轨迹
+        """
+        if self.trajectory is None:
+            num_chunks = -(-self.trajectory_length // self.chunk_size)
+            t = ColumnarTrajectory(self.id.id, max(self.trajectory_length, 1))
+            for k in range(num_chunks - 1):
+                t.extend(await self._retrieve_chunk(k))
+            t.extend(self.tail_chunk)
+            self.trajectory = t
+        return self.trajectory
+
+    async def _retrieve_trajectory(self) -> int:
+        """
+        只恢复清单与尾部分块，完整轨迹等到查询时再加载
+        """
+        has_value, manifest = await self._state_manager.try_get_state(self.TRAJECTORY_MANIFEST_KEY)
+        if has_value:
+            self.chunk_size = manifest["chunk_size"]
+            self.trajectory_length = manifest["length"]
+            if self.trajectory_length > 0:
+                self.tail_chunk = await self._retrieve_chunk((self.trajectory_length - 1) // self.chunk_size)
+            await self.logger.info(f"{self.id.id}_Got trajectory restored: {self.trajectory_length} points")
+            return self.trajectory_length
         has_value, val = await self._state_manager.try_get_state(self.TRAJECTORY_STATE_KEY)
         if has_value:
-            self.trajectory = list(map(lambda x: from_dict(TrajectoryPoint, x), val))
-            await self.logger.info(f"{self.id.id}_Got trajectory restored:{self.trajectory}")
-            return self.trajectory
+            # 旧版整条轨迹存储，迁移为分块存储
+            self.trajectory = ColumnarTrajectory(self.id.id)
+            await self._append_trajectory(points_from_wire(val))
+            await self._state_manager.remove_state(self.TRAJECTORY_STATE_KEY)
+            await self.logger.info(f"{self.id.id}_Got trajectory migrated: {self.trajectory_length} points")
+            return self.trajectory_length
         else:
+            self.trajectory = ColumnarTrajectory(self.id.id)
             await self.logger.info("No trajectory available")
-            return None
+            return 0
 
     async def _on_activate(self) -> None:
         await self._retrieve_previous_point()
         await self._retrieve_trajectory()
+        has_value, watchers = await self._state_manager.try_get_state(self.WATCHERS_KEY)
+        if has_value:
+            self.watchers = set(watchers)
         await self.logger.info(f"{self.id}_TrajectoryAssembler activated")
 
     async def _on_deactivate(self) -> None:
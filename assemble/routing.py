@@ -0,0 +1,87 @@
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import h3
+
+
+class RegionRoutingCache:
+    """
+    进程内共享的 H3网格 -> 索引分区 路由缓存
+
+    以各协调者分片的分裂纪元标记，分区退役时按反向索引精确失效
+    """
+
+    def __init__(self, resolution: int, capacity: int):
+        self.resolution: int = resolution
+        self.capacity: int = capacity
+        # 最近一次从各协调者分片得知的纪元，未同步的分片为-1
+        self.epochs: Dict[str, int] = {}
+        self.entries: "OrderedDict[str, Tuple[str, ...]]" = OrderedDict()
+        # 分区 -> 路由到该分区的网格
+        self.by_region: Dict[str, Set[str]] = defaultdict(set)
+
+    def cell(self, lng: float, lat: float) -> str:
+        return h3.geo_to_h3(lat, lng, self.resolution)
+
+    def epoch(self, shard: str) -> int:
+        return self.epochs.get(shard, -1)
+
+    def get(self, cell: str, lng: float, lat: float) -> Optional[Tuple[str, ...]]:
+        """
+        分区可能比缓存网格更细，同一网格内的点不一定落在同一分区，
+        命中时逐个确认点仍在缓存的分区内，否则视为未命中
+        """
+        regions = self.entries.get(cell)
+        if regions is None:
+            return None
+        if any(h3.geo_to_h3(lat, lng, h3.h3_get_resolution(r)) != r for r in regions):
+            return None
+        self.entries.move_to_end(cell)
+        return regions
+
+    def put(self, cell: str, regions: List[str]) -> None:
+        if self.capacity <= 0:
+            return
+        self._drop(cell)
+        self.entries[cell] = tuple(regions)
+        for r in regions:
+            self.by_region[r].add(cell)
+        while len(self.entries) > self.capacity:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, cell: str) -> None:
+        for r in self.entries.pop(cell, ()):
+            cells = self.by_region.get(r)
+            if cells is not None:
+                cells.discard(cell)
+                if not cells:
+                    del self.by_region[r]
+
+    def retire(self, region: str, successors: Optional[Dict[str, str]] = None) -> None:
+        """
+        分区退役：已知接替分区的网格直接改写，其余指向该分区的条目失效
+        """
+        successors = successors or {}
+        for cell in list(self.by_region.get(region, ())):
+            if cell in successors:
+                regions = [r for r in self.entries[cell] if r != region]
+                if successors[cell] not in regions:
+                    regions.append(successors[cell])
+                self.put(cell, regions)
+            else:
+                self._drop(cell)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.by_region.clear()
+
+    def apply(self, shard: str, reply: dict) -> None:
+        """
+        应用协调者分片回复中附带的纪元与退役分区
+        """
+        if reply["retired"] is None:
+            self.clear()
+        else:
+            for region in reply["retired"]:
+                self.retire(region)
+        self.epochs[shard] = reply["epoch"]
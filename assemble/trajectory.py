@@ -0,0 +1,48 @@
+from typing import List, Iterable
+
+import numpy as np
+
+from interfaces.packed import pack_trajectory
+from interfaces.types import TrajectoryPoint
+
+
+class ColumnarTrajectory:
+    """
+    列式存储的轨迹：经纬度为float64数组，时间为int64的epoch秒，容量按倍数增长
+    """
+
+    def __init__(self, id: str, capacity: int = 16):
+        self.id: str = id
+        self.length: int = 0
+        self.xy: np.ndarray = np.empty((capacity, 2), dtype=np.float64)
+        self.time: np.ndarray = np.empty(capacity, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _reserve(self, n: int) -> None:
+        capacity = len(self.time)
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        xy = np.empty((capacity, 2), dtype=np.float64)
+        xy[:self.length] = self.xy[:self.length]
+        time = np.empty(capacity, dtype=np.int64)
+        time[:self.length] = self.time[:self.length]
+        self.xy, self.time = xy, time
+
+    def extend(self, points: Iterable[TrajectoryPoint]) -> None:
+        points = list(points)
+        n = self.length + len(points)
+        self._reserve(n)
+        self.xy[self.length:n] = [(p.lng, p.lat) for p in points]
+        self.time[self.length:n] = [p.time for p in points]
+        self.length = n
+
+    def points(self) -> List[TrajectoryPoint]:
+        return [TrajectoryPoint(self.id, t, lng, lat)
+                for (lng, lat), t in zip(self.xy[:self.length].tolist(), self.time[:self.length].tolist())]
+
+    def pack(self, start: int = 0) -> bytes:
+        return pack_trajectory(self.xy[start:self.length], self.time[start:self.length])
@@ -1,17 +1,96 @@
-from typing import List, Dict
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Tuple
 
 import numpy as np
 import traj_dist.distance as tdist
 from aiologger import Logger
 from aiologger.formatters.base import Formatter
 from aiologger.levels import LogLevel
-from dacite import from_dict
 from dapr.actor import Actor, ActorId, ActorProxy
 from dapr.actor.runtime.context import ActorRuntimeContext
 
+from compute import kernel
+from compute.cache import PairCache, TrajectoryCache, hausdorff_cached
 from interfaces.distance_compute_interface import DistanceComputeInterface
+from interfaces.packed import from_wire, unpack_trajectory
 from interfaces.trajectory_assembler_interface import TrajectoryAssemblerInterface
-from interfaces.types import TrajectoryPoint
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 每个计算请求同时拉取的候选轨迹数量
+    COMPUTE_FETCH_CONCURRENCY = para.get("COMPUTE_FETCH_CONCURRENCY", 8)
+    # 同一主机上运行的计算服务副本数，见start.sh
+    COMPUTE_REPLICAS = para.get("COMPUTE_REPLICAS", 5)
+    # 每个计算服务副本的距离计算进程数，默认由各副本平分本机核数，跨主机部署时按实际情况设置
+    COMPUTE_WORKERS = para.get("COMPUTE_WORKERS", max(1, (os.cpu_count() or 1) // COMPUTE_REPLICAS))
+    # 距离计算引擎，batched为批量向量化内核，traj_dist为逐对调用traj_dist
+    HAUSDORFF_ENGINE = para.get("HAUSDORFF_ENGINE", "batched")
+    # 批量内核每块距离矩阵的最大元素数，限制内存占用
+    COMPUTE_TILE_SIZE = para.get("COMPUTE_TILE_SIZE", 1 << 20)
+    # 拉取到的候选点数达到该值即提交一批计算
+    COMPUTE_BATCH_POINTS = para.get("COMPUTE_BATCH_POINTS", 20000)
+    # 所有计算进程缓存(目标, 候选)最近距离向量的总字节数，0为关闭缓存
+    COMPUTE_PAIR_CACHE_BYTES = para.get("COMPUTE_PAIR_CACHE_BYTES", 256 << 20)
+    # 计算服务进程缓存轨迹数组的总字节数，0为关闭缓存
+    COMPUTE_TRAJECTORY_CACHE_BYTES = para.get("COMPUTE_TRAJECTORY_CACHE_BYTES", 128 << 20)
+
+print(f"{COMPUTE_FETCH_CONCURRENCY=}", flush=True)
+print(f"{COMPUTE_REPLICAS=}", flush=True)
+print(f"{COMPUTE_WORKERS=}", flush=True)
+print(f"{HAUSDORFF_ENGINE=}", flush=True)
+print(f"{COMPUTE_TILE_SIZE=}", flush=True)
+print(f"{COMPUTE_BATCH_POINTS=}", flush=True)
+print(f"{COMPUTE_PAIR_CACHE_BYTES=}", flush=True)
+print(f"{COMPUTE_TRAJECTORY_CACHE_BYTES=}", flush=True)
+
+# 同一进程内所有计算actor共享，缓存中的数组只读
+TRAJECTORY_CACHE = TrajectoryCache(COMPUTE_TRAJECTORY_CACHE_BYTES)
+# 正在拉取的轨迹，同时请求同一轨迹的actor共用一次拉取
+_inflight: Dict[str, asyncio.Future] = {}
+
+_compute_workers: List[ProcessPoolExecutor] = []
+# 计算进程内的距离向量缓存，只在计算进程中创建
+_pair_cache: Optional[PairCache] = None
+
+
+def compute_worker(candidate_id: str) -> ProcessPoolExecutor:
+    """
+    同一进程内所有计算actor共享的单进程计算池，首次使用时创建
+
+    同一候选总是交给同一个计算进程，使其缓存的距离向量能被后续查询复用；
+    spawn避免计算进程继承服务进程中正在运行的事件循环与各线程持有的锁
+    """
+    if not _compute_workers:
+        context = multiprocessing.get_context("spawn")
+        _compute_workers.extend(ProcessPoolExecutor(1, mp_context=context) for _ in range(COMPUTE_WORKERS))
+    return _compute_workers[zlib.crc32(candidate_id.encode()) % len(_compute_workers)]
+
+
+def hausdorff_batch(target: np.ndarray, candidates: List[np.ndarray], threshold: Optional[float],
+                    target_id: Optional[str] = None, candidate_ids: Optional[List[str]] = None) -> List[float]:
+    """
+    在计算进程中计算目标到一批候选的距离，超过阈值的结果只是一个大于阈值的下界
+
+    给出轨迹id时复用本进程缓存的距离向量，只计算双方新增的点
+    """
+    global _pair_cache
+    if HAUSDORFF_ENGINE == "traj_dist":
+        return [tdist.hausdorff(target, c, "spherical") for c in candidates]
+    threshold = math.inf if threshold is None else threshold
+    if target_id is not None and COMPUTE_PAIR_CACHE_BYTES > 0:
+        if _pair_cache is None:
+            _pair_cache = PairCache(COMPUTE_PAIR_CACHE_BYTES // COMPUTE_WORKERS)
+        return hausdorff_cached(_pair_cache, target_id, target, candidate_ids, candidates, threshold,
+                                tile_size=COMPUTE_TILE_SIZE)
+    points, offsets = kernel.pack_candidates(candidates)
+    return kernel.hausdorff_many(target, points, offsets, threshold, tile_size=COMPUTE_TILE_SIZE).tolist()
 
 
 class DistanceComputeActor(Actor, DistanceComputeInterface):
@@ -21,29 +100,84 @@ class DistanceComputeActor(Actor, DistanceComputeInterface):
                                                    formatter=Formatter("%(name)s-%(asctime)s: %(message)s"))
 
     @staticmethod
-    async def _get_trajectory_to_numpy(i: str) -> np.ndarray:
+    async def _fetch_trajectory(i: str) -> np.ndarray:
+        """
+        只向assembler索要缓存之后新增的点，轨迹没有变化时应答几乎为空
+        """
         proxy = ActorProxy.create('TrajectoryAssemblerActor', ActorId(i), TrajectoryAssemblerInterface)
-        raw_data: List[TrajectoryPoint] = [from_dict(TrajectoryPoint, i) for i in
-                                           await proxy.Query()]
-        return np.array([[i.lng, i.lat] for i in raw_data])
+        cached = TRAJECTORY_CACHE.get(i)
+        reply = await proxy.QueryPackedFrom(0 if cached is None else len(cached))
+        xy, _ = unpack_trajectory(from_wire(reply["points"]))
+        # 轨迹变短说明状态已被重置，assembler会从头返回整条轨迹
+        if reply["offset"] > 0:
+            xy = np.concatenate([cached, xy]) if len(xy) else cached
+        TRAJECTORY_CACHE.put(i, xy)
+        return xy
+
+    @classmethod
+    async def _get_trajectory_to_numpy(cls, i: str) -> np.ndarray:
+        if COMPUTE_TRAJECTORY_CACHE_BYTES <= 0:
+            proxy = ActorProxy.create('TrajectoryAssemblerActor', ActorId(i), TrajectoryAssemblerInterface)
+            xy, _ = unpack_trajectory(from_wire(await proxy.QueryPacked()))
+            return xy
+        if i not in _inflight:
+            _inflight[i] = asyncio.ensure_future(cls._fetch_trajectory(i))
+            _inflight[i].add_done_callback(lambda _: _inflight.pop(i, None))
+        return await asyncio.shield(_inflight[i])
 
     async def compute_hausdorff_with_id(self, data: dict) -> Dict[str, float]:
         target_trajectory_id: str = data["target_trajectory_id"]
         candidates: List[str] = data["candidates"]
         target = await self._get_trajectory_to_numpy(target_trajectory_id)
-        return await self._calculate_result(target, candidates)
+        return await self._calculate_result(target, candidates, data.get("threshold"), target_trajectory_id)
 
     async def compute_hausdorff_with_provided_track(self, data: dict) -> Dict[str, float]:
         target_trajectory: List[List[float]] = data["target_trajectory"]
         candidates: List[str] = data["candidates"]
         target = np.array(target_trajectory)
-        return await self._calculate_result(target, candidates)
+        return await self._calculate_result(target, candidates, data.get("threshold"))
+
+    async def _calculate_result(self, target_trajectory: np.ndarray, candidates: List[str],
+                                threshold: Optional[float] = None,
+                                target_trajectory_id: Optional[str] = None) -> Dict[str, float]:
+        """
+        有限并发地拉取候选轨迹，拉取到的候选按所属计算进程分批计算，拉取与计算互相重叠
+
+        给定阈值时只返回距离不超过阈值的候选
+        """
+        semaphore = asyncio.Semaphore(COMPUTE_FETCH_CONCURRENCY)
+        loop = asyncio.get_running_loop()
+
+        async def fetch(candidate_id: str) -> Tuple[str, np.ndarray]:
+            async with semaphore:
+                return candidate_id, await self._get_trajectory_to_numpy(candidate_id)
+
+        batches: List[Tuple[List[str], asyncio.Future]] = []
+        # 计算进程 -> 尚未提交的候选及其点数
+        pending: Dict[ProcessPoolExecutor, List[Tuple[str, np.ndarray]]] = defaultdict(list)
+        pending_points: Dict[ProcessPoolExecutor, int] = defaultdict(int)
+
+        def submit(worker: ProcessPoolExecutor) -> None:
+            ids, arrays = map(list, zip(*pending.pop(worker)))
+            pending_points.pop(worker)
+            batches.append((ids, loop.run_in_executor(worker, hausdorff_batch, target_trajectory, arrays,
+                                                      threshold, target_trajectory_id, ids)))
 
-    async def _calculate_result(self, target_trajectory: np.ndarray, candidates: List[str]) -> Dict[str, float]:
+        # 拉取到的候选攒够一批即提交计算
+        for fetched in asyncio.as_completed([fetch(c) for c in candidates]):
+            candidate_id, candidate = await fetched
+            worker = compute_worker(candidate_id)
+            pending[worker].append((candidate_id, candidate))
+            pending_points[worker] += len(candidate)
+            if pending_points[worker] >= COMPUTE_BATCH_POINTS:
+                submit(worker)
+        for worker in list(pending):
+            submit(worker)
         res = dict()
-        for candidate_id in candidates:
-            candidate: np.ndarray = await self._get_trajectory_to_numpy(candidate_id)
-            res[candidate_id] = tdist.hausdorff(target_trajectory, candidate, "spherical")
+        for batch_ids, future in batches:
+            for candidate_id, d in zip(batch_ids, await future):
+                if threshold is None or d <= threshold:
+                    res[candidate_id] = d
         return res
 
     async def _on_deactivate(self) -> None:
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from compute import kernel
+
+# 每个缓存条目除两条距离向量外的固定开销估计
+ENTRY_OVERHEAD = 256
+
+
+@dataclass
+class PairState:
+    """
+    一对(目标, 候选)轨迹在各自长度为n、m时的有向最近距离
+    """
+    # 候选各点到目标轨迹的最近距离，长度m
+    forward: np.ndarray
+    # 目标各点到候选轨迹的最近距离，长度n
+    backward: np.ndarray
+    # 计算时双方的末点，用于确认轨迹只是追加了新点
+    target_last: Tuple[float, float]
+    candidate_last: Tuple[float, float]
+
+    @property
+    def nbytes(self) -> int:
+        return self.forward.nbytes + self.backward.nbytes + ENTRY_OVERHEAD
+
+    def distance(self) -> float:
+        return _distance(self.forward, self.backward)
+
+    def extends_to(self, target: np.ndarray, candidate: np.ndarray) -> bool:
+        n, m = len(self.backward), len(self.forward)
+        return (0 < n <= len(target) and 0 < m <= len(candidate)
+                and tuple(target[n - 1]) == self.target_last and tuple(candidate[m - 1]) == self.candidate_last)
+
+
+def _distance(forward: np.ndarray, backward: np.ndarray) -> float:
+    return float(np.fmax(np.fmax.reduce(forward, initial=0.0), np.fmax.reduce(backward, initial=0.0)))
+
+
+def _last(a: np.ndarray) -> Tuple[float, float]:
+    return float(a[-1, 0]), float(a[-1, 1])
+
+
+def extend_pair(state: PairState, target: np.ndarray, candidate: np.ndarray, tile_size: int) -> PairState:
+    """
+    双方追加新点后更新最近距离：旧点只需再算到对方新增线段的距离，新点算到对方整条轨迹的距离
+    """
+    n, m = len(state.backward), len(state.forward)
+    forward = np.empty(len(candidate))
+    forward[:m] = state.forward
+    if len(target) > n:
+        np.fmin(forward[:m], kernel.nearest_to_path(target[n - 1:], candidate[:m], tile_size), out=forward[:m])
+    forward[m:] = kernel.nearest_to_path(target, candidate[m:], tile_size)
+    backward = np.empty(len(target))
+    backward[:n] = state.backward
+    if len(candidate) > m:
+        np.fmin(backward[:n], kernel.nearest_to_path(candidate[m - 1:], target[:n], tile_size), out=backward[:n])
+    backward[n:] = kernel.nearest_to_path(candidate, target[n:], tile_size)
+    return PairState(forward, backward, _last(target), _last(candidate))
+
+
+class PairCache:
+    """
+    按最近使用淘汰的距离向量缓存，总大小不超过budget字节
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.entries: "OrderedDict[Tuple[str, str], PairState]" = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[PairState]:
+        state = self.entries.get(key)
+        if state is not None:
+            self.entries.move_to_end(key)
+        return state
+
+    def put(self, key: Tuple[str, str], state: PairState) -> None:
+        self.discard(key)
+        if state.nbytes > self.budget:
+            return
+        self.entries[key] = state
+        self.size += state.nbytes
+        while self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def discard(self, key: Tuple[str, str]) -> None:
+        state = self.entries.pop(key, None)
+        if state is not None:
+            self.size -= state.nbytes
+
+
+def hausdorff_cached(cache: PairCache, target_id: str, target: np.ndarray, candidate_ids: List[str],
+                     candidates: List[np.ndarray], threshold: float, samples: int = 8,
+                     tile_size: int = 1 << 20) -> List[float]:
+    """
+    与kernel.hausdorff_many结果一致，但复用缓存的最近距离，已缓存的候选只计算双方新增的点
+
+    未缓存的候选先用抽样点求下界，超过阈值的只返回下界且不缓存，其余完整计算后存入缓存
+    """
+    res: List[Optional[float]] = [None] * len(candidates)
+    fresh: List[int] = []
+    for i, (candidate_id, candidate) in enumerate(zip(candidate_ids, candidates)):
+        state = cache.get((target_id, candidate_id))
+        if state is None or len(target) == 0 or len(candidate) == 0 or not state.extends_to(target, candidate):
+            fresh.append(i)
+            continue
+        if len(state.backward) < len(target) or len(state.forward) < len(candidate):
+            state = extend_pair(state, target, candidate, tile_size)
+            cache.put((target_id, candidate_id), state)
+        res[i] = state.distance()
+    if fresh:
+        points, offsets = kernel.pack_candidates([candidates[i] for i in fresh])
+        owner = np.repeat(np.arange(len(fresh)), np.diff(offsets))
+        bound = np.zeros(len(fresh))
+        picked = kernel.sample_mask(offsets, samples)
+        np.fmax.at(bound, owner[picked], kernel.nearest_to_path(target, points[picked], tile_size))
+        alive = np.flatnonzero(bound <= threshold)
+        for k in np.flatnonzero(bound > threshold):
+            res[fresh[k]] = float(bound[k])
+        if len(alive):
+            survivors = [candidates[fresh[k]] for k in alive]
+            survivor_points, survivor_offsets = kernel.pack_candidates(survivors)
+            forward = kernel.nearest_to_path(target, survivor_points, tile_size)
+            backward = kernel.backward_nearest(target, survivor_points, survivor_offsets, tile_size)
+            for j, k in enumerate(alive):
+                i = fresh[k]
+                candidate_forward = forward[survivor_offsets[j]:survivor_offsets[j + 1]]
+                res[i] = _distance(candidate_forward, backward[:, j])
+                if len(target) and len(candidates[i]):
+                    cache.put((target_id, candidate_ids[i]), PairState(
+                        candidate_forward.copy(), backward[:, j].copy(), _last(target), _last(candidates[i])))
+    return res
+
+
+class TrajectoryCache:
+    """
+    按最近使用淘汰的轨迹经纬度数组缓存，总大小不超过budget字节
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    def get(self, trajectory_id: str) -> Optional[np.ndarray]:
+        xy = self.entries.get(trajectory_id)
+        if xy is not None:
+            self.entries.move_to_end(trajectory_id)
+        return xy
+
+    def put(self, trajectory_id: str, xy: np.ndarray) -> None:
+        previous = self.entries.pop(trajectory_id, None)
+        if previous is not None:
+            self.size -= previous.nbytes
+        if xy.nbytes > self.budget:
+            return
+        self.entries[trajectory_id] = xy
+        self.size += xy.nbytes
+        while self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
@@ -0,0 +1,181 @@
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+# 与traj_dist编译后的球面距离保持一致，其中pi与rad都声明为单精度float
+RAD = float(np.float32(float(np.float32(3.14159265)) / 180.0))
+R = 6378137.0
+# traj_dist中点到空路径的距离
+NO_PATH = 9e100
+
+
+def great_circle_distance(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    d_lat = RAD * (lat2 - lat1)
+    d_lon = RAD * (lon2 - lon1)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(RAD * lat1) * np.cos(RAD * lat2) * np.sin(d_lon / 2) ** 2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def initial_bearing(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    d_lon = RAD * (lon2 - lon1)
+    y = np.sin(d_lon) * np.cos(RAD * lat2)
+    x = np.cos(RAD * lat1) * np.sin(RAD * lat2) - np.sin(RAD * lat1) * np.cos(RAD * lat2) * np.cos(d_lon)
+    return np.arctan2(y, x)
+
+
+def point_to_path(path: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """
+    各点到路径上各线段的距离矩阵(len(points), len(path) - 1)，与traj_dist的point_to_path逐元素一致
+    """
+    lon1, lat1 = path[:-1, 0], path[:-1, 1]
+    lon2, lat2 = path[1:, 0], path[1:, 1]
+    lon3, lat3 = points[:, 0:1], points[:, 1:2]
+    d12 = great_circle_distance(lon1, lat1, lon2, lat2)
+    # 点到各顶点的距离只算一次，线段起点与终点共用
+    d = great_circle_distance(path[:, 0], path[:, 1], lon3, lat3)
+    d13, d23 = d[:, :-1], d[:, 1:]
+    with np.errstate(invalid="ignore"):
+        crt = np.arcsin(np.sin(d13 / R) * np.sin(
+            initial_bearing(lon1, lat1, lon3, lat3) - initial_bearing(lon1, lat1, lon2, lat2))) * R
+        # 与C的acos一样，越界得到NaN，下面的比较为假
+        d1p = np.arccos(np.cos(d13 / R) / np.cos(crt / R)) * R
+        d2p = np.arccos(np.cos(d23 / R) / np.cos(crt / R)) * R
+    return np.where((d1p > d12) | (d2p > d12), np.fmin(d13, d23), np.abs(crt))
+
+
+def directed_hausdorff(path: np.ndarray, points: np.ndarray, threshold: float = math.inf,
+                       tile_size: int = 256, dh: float = 0.0) -> float:
+    """
+    points中各点到path距离的最大值，分块计算，部分最大值超过阈值即提前返回
+    """
+    for i in range(0, len(points), tile_size):
+        # fmin/fmax忽略NaN，与traj_dist相同
+        nearest = np.fmin.reduce(point_to_path(path, points[i:i + tile_size]), axis=1, initial=NO_PATH)
+        dh = np.fmax.reduce(nearest, initial=dh)
+        if dh > threshold:
+            break
+    return float(dh)
+
+
+def _sample(n: int, samples: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    均匀抽取包括首尾在内的若干点，其余点另行返回
+    """
+    picked = np.unique(np.linspace(0, n - 1, min(samples, n)).astype(np.int64))
+    rest = np.setdiff1d(np.arange(n), picked, assume_unique=True)
+    return picked, rest
+
+
+def hausdorff(t0: np.ndarray, t1: np.ndarray, threshold: float = math.inf,
+              samples: int = 8, tile_size: int = 256) -> float:
+    """
+    球面Hausdorff距离，结果与traj_dist.distance.hausdorff(t0, t1, "spherical")一致
+
+    先计算两侧抽样点的距离，它们是整体距离的下界，超过阈值的候选无需再算其余点；
+    全量计算时部分最大值一旦超过阈值也提前放弃。提前放弃时返回的是一个大于阈值的下界
+    """
+    picked0, rest0 = _sample(len(t0), samples)
+    picked1, rest1 = _sample(len(t1), samples)
+    h = 0.0
+    for path, points in ((t0, t1[picked1]), (t1, t0[picked0]), (t0, t1[rest1]), (t1, t0[rest0])):
+        h = directed_hausdorff(path, points, threshold, tile_size, h)
+        if h > threshold:
+            break
+    return h
+
+
+def pack_candidates(trajectories: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    多条轨迹首尾相接存放，第k条为points[offsets[k]:offsets[k + 1]]
+    """
+    offsets = np.zeros(len(trajectories) + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in trajectories], out=offsets[1:])
+    points = np.concatenate(trajectories) if trajectories else np.empty((0, 2))
+    return points.reshape(-1, 2), offsets
+
+
+def _owners(offsets: np.ndarray) -> np.ndarray:
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def nearest_to_path(path: np.ndarray, points: np.ndarray, tile_size: int = 1 << 20) -> np.ndarray:
+    """
+    points中各点到路径的最近距离，分块计算，每块的距离矩阵不超过tile_size个元素
+    """
+    rows = max(1, tile_size // max(len(path) - 1, 1))
+    nearest = np.empty(len(points))
+    for i in range(0, len(points), rows):
+        nearest[i:i + rows] = np.fmin.reduce(point_to_path(path, points[i:i + rows]), axis=1, initial=NO_PATH)
+    return nearest
+
+
+def _forward(target: np.ndarray, points: np.ndarray, owner: np.ndarray, dh: np.ndarray, tile_size: int) -> None:
+    """
+    points中各点到目标轨迹的距离，按所属候选取最大值并入dh
+    """
+    np.fmax.at(dh, owner, nearest_to_path(target, points, tile_size))
+
+
+def backward_nearest(target: np.ndarray, points: np.ndarray, offsets: np.ndarray, tile_size: int) -> np.ndarray:
+    """
+    目标轨迹各点到每条候选轨迹的最近距离，形状为(len(target), 候选数)
+    """
+    k = len(offsets) - 1
+    nearest = np.full((len(target), k), NO_PATH)
+    segment_owner = _owners(offsets)[:-1]
+    # 跨越两条候选轨迹的线段不计入
+    valid = np.ones(max(len(points) - 1, 0), dtype=bool)
+    boundaries = offsets[1:-1]
+    valid[boundaries[(boundaries > 0) & (boundaries < len(points))] - 1] = False
+    columns = max(1, tile_size // max(len(target), 1))
+    for a in range(0, len(valid), columns):
+        b = min(a + columns, len(valid))
+        d = point_to_path(points[a:b + 1], target)
+        d[:, ~valid[a:b]] = np.nan
+        owner = segment_owner[a:b]
+        starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        runs = owner[starts]
+        nearest[:, runs] = np.fmin(nearest[:, runs], np.fmin.reduceat(d, starts, axis=1))
+    return nearest
+
+
+def _backward(target: np.ndarray, points: np.ndarray, offsets: np.ndarray, tile_size: int) -> np.ndarray:
+    """
+    目标轨迹各点到每条候选轨迹的距离的最大值
+    """
+    nearest = backward_nearest(target, points, offsets, tile_size)
+    return np.fmax.reduce(nearest, axis=0, initial=0.0) if len(target) else np.zeros(len(offsets) - 1)
+
+
+def sample_mask(offsets: np.ndarray, samples: int) -> np.ndarray:
+    """
+    每条候选均匀抽取包括首尾在内的若干点
+    """
+    picked = np.zeros(offsets[-1], dtype=bool)
+    for c in range(len(offsets) - 1):
+        if offsets[c + 1] > offsets[c]:
+            picked[np.unique(np.linspace(offsets[c], offsets[c + 1] - 1, samples).astype(np.int64))] = True
+    return picked
+
+
+def hausdorff_many(target: np.ndarray, points: np.ndarray, offsets: np.ndarray, threshold: float = math.inf,
+                   samples: int = 8, tile_size: int = 1 << 20) -> np.ndarray:
+    """
+    目标轨迹到一批候选轨迹的球面Hausdorff距离，每条结果与hausdorff(target, candidate)一致
+
+    候选轨迹由pack_candidates打包，所有候选一起分块向量化计算，每块的距离矩阵不超过tile_size个元素。
+    先用各候选的抽样点求下界，只对未超过阈值的候选计算其余部分，超过阈值的结果只是一个大于阈值的下界
+    """
+    k = len(offsets) - 1
+    owner = _owners(offsets)
+    dh = np.zeros(k)
+    picked = sample_mask(offsets, samples)
+    _forward(target, points[picked], owner[picked], dh, tile_size)
+    rest = ~picked & (dh <= threshold)[owner]
+    _forward(target, points[rest], owner[rest], dh, tile_size)
+    alive = np.flatnonzero(dh <= threshold)
+    if len(alive):
+        survivors, survivor_offsets = pack_candidates([points[offsets[c]:offsets[c + 1]] for c in alive])
+        dh[alive] = np.fmax(dh[alive], _backward(target, survivors, survivor_offsets, tile_size))
+    return dh
@@ -1,31 +1,39 @@
+import asyncio
 import json
+import math
+import time
 import traceback
 import warnings
 from collections import defaultdict
-from dataclasses import asdict
-from typing import Optional, List, Dict, Set, Tuple
+from typing import List, Dict, Set, Tuple
 
 import aiorwlock
 import h3
+import numpy as np
 from aiologger import Logger
 from aiologger.formatters.base import Formatter
 from aiologger.levels import LogLevel
-from dacite import from_dict
 from dapr.actor import Actor, ActorId, ActorProxy
 from dapr.actor.runtime._method_context import ActorMethodContext
 from dapr.actor.runtime.context import ActorRuntimeContext
 
-from interfaces.accumulator_interface import AccumulatorInterface
-
-warnings.simplefilter(action='ignore', category=FutureWarning)
-from geopandas import GeoDataFrame
 from pyproj import Transformer
 from shapely import wkt
 from shapely.geometry import LineString
+from shapely.prepared import prep, PreparedGeometry
 
+with warnings.catch_warnings():
+    # h3.unstable在导入时提示接口可能变化，所用的版本已在依赖中固定
+    warnings.simplefilter("ignore")
+    import h3.unstable.vect as h3_vect
+
+from index.spatial import SegmentGrid, SegmentBuffer
+from index_meta.shard import meta_proxy, region_shards
+from interfaces.accumulator_interface import AccumulatorInterface
+from interfaces.codec import segments_from_wire, segments_to_wire
 from interfaces.distributed_index_interface import DistributedIndexInterface
-from interfaces.index_meta_interface import IndexMetaInterface
-from interfaces.types import TrajectorySegment, TrajectoryPoint
+from interfaces.notify import notify_standing_queries
+from interfaces.types import TrajectorySegment
 
 with open("tests/parameters.json") as f:
     para: dict = json.load(f)
@@ -35,10 +43,22 @@ with open("tests/parameters.json") as f:
     TREE_INSERTION_THRESHOLD = para.get("TREE_INSERTION_THRESHOLD", 0.2)
     # 分裂所需的树索引阈值
     SPLIT_THRESHOLD = para.get("SPLIT_THRESHOLD", 2000)
+    # 网格索引的格子边长上限(墨卡托米)
+    GRID_CELL_SIZE = para.get("GRID_CELL_SIZE", 1000)
+    # 网格索引的格子边长占分区H3网格边长的比例，分区越细格子越小
+    GRID_CELL_EDGE_RATIO = para.get("GRID_CELL_EDGE_RATIO", 0.25)
+    # 增量日志中的线段数超过快照的该倍数时压缩成新快照
+    DELTA_COMPACTION_RATIO = para.get("DELTA_COMPACTION_RATIO", 1.0)
+    # 增量日志的最大条数，避免激活时读取过多的键
+    DELTA_LOG_MAX_ENTRIES = para.get("DELTA_LOG_MAX_ENTRIES", 256)
 
 print(f"{MAX_BUFFER_SIZE=}", flush=True)
 print(f"{TREE_INSERTION_THRESHOLD=}", flush=True)
 print(f"{SPLIT_THRESHOLD=}", flush=True)
+print(f"{GRID_CELL_SIZE=}", flush=True)
+print(f"{GRID_CELL_EDGE_RATIO=}", flush=True)
+print(f"{DELTA_COMPACTION_RATIO=}", flush=True)
+print(f"{DELTA_LOG_MAX_ENTRIES=}", flush=True)
 
 
 class DistributedIndexActor(Actor, DistributedIndexInterface):
@@ -52,6 +72,8 @@ class DistributedIndexActor(Actor, DistributedIndexInterface):
         self.STATE_KEY = f"DistributedIndexActor_{self.id.id}"
         self.BUFFER_KEY = f"DistributedIndexActor_{self.id.id}_buffer"
         self.RETIRED_KRY = f"DistributedIndexActor_{self.id.id}_retired"
+        self.DELTA_LOG_KEY = f"DistributedIndexActor_{self.id.id}_log"
+        self.SUBSCRIPTIONS_KEY = f"DistributedIndexActor_{self.id.id}_subscriptions"
 
         self.retired: bool = False
 
@@ -63,29 +85,58 @@ class DistributedIndexActor(Actor, DistributedIndexInterface):
         # 球面坐标转墨卡托平面投影
         self.transformer = Transformer.from_crs(4326, 3857, always_xy=True)
 
-        # str-tree索引
-        self.segments: Optional[GeoDataFrame] = None
+        # 网格索引
+        self.segments: SegmentGrid = SegmentGrid(self.grid_cell_size(self.h))
         # Buffer
-        self.cache: Set[TrajectorySegment] = set()
+        self.cache: SegmentBuffer = SegmentBuffer()
+        # 各轨迹在本分区的线段数，查询时一并返回供调度估计计算代价
+        self.trajectory_segments: Dict[str, int] = defaultdict(int)
+
+        # 本次调用新增、尚未持久化的线段
+        self.pending: List[TrajectorySegment] = []
+        # 快照中的线段数，以及快照之后的增量日志条数与线段数
+        self.snapshot_size: int = 0
+        self.delta_entries: int = 0
+        self.delta_size: int = 0
 
         self.logger = Logger.with_default_handlers(name=f"DistributedIndex_{self.id.id}", level=LogLevel.INFO,
                                                    formatter=Formatter("%(name)s-%(asctime)s: %(message)s"))
 
         self.lock = aiorwlock.RWLock()
         self.full = False
+        self.split_started: float = 0
+
+        # 持续查询id -> 墨卡托平面上的查询范围
+        self.subscriptions: Dict[str, str] = {}
+        self.subscription_areas: Dict[str, PreparedGeometry] = {}
+
+    def _delta_key(self, k: int) -> str:
+        return f"{self.STATE_KEY}_delta_{k}"
 
     async def _on_activate(self) -> None:
-        has_value, p = await self._state_manager.try_get_state(self.BUFFER_KEY)
-        if has_value:
-            val: Set[TrajectorySegment] = set(map(lambda x: from_dict(TrajectorySegment, x), p))
-            self.cache.update(val)
         has_value, p = await self._state_manager.try_get_state(self.STATE_KEY)
         if has_value:
-            val: Set[TrajectorySegment] = set(map(lambda x: from_dict(TrajectorySegment, x), p))
-            self.cache.update(val)
+            snapshot = segments_from_wire(p)
+            self.snapshot_size = len(snapshot)
+            self._buffer(snapshot)
             # self.logger.info("Got segments restored")
         # else:
         #     self.logger.info("No previous_segments available")
+        has_value, p = await self._state_manager.try_get_state(self.DELTA_LOG_KEY)
+        if has_value:
+            self.delta_entries, self.delta_size = p["entries"], p["size"]
+            for k in range(self.delta_entries):
+                _, delta = await self._state_manager.try_get_state(self._delta_key(k))
+                self._buffer(segments_from_wire(delta or []))
+        has_value, p = await self._state_manager.try_get_state(self.BUFFER_KEY)
+        if has_value:
+            # 旧版单独保存的buffer，转入增量日志
+            self.pending.extend(self._buffer(segments_from_wire(p)))
+            await self._state_manager.remove_state(self.BUFFER_KEY)
+        has_value, p = await self._state_manager.try_get_state(self.SUBSCRIPTIONS_KEY)
+        if has_value:
+            self.subscriptions = p
+            self.subscription_areas = {q: prep(wkt.loads(w)) for q, w in p.items()}
         has_value, p = await self._state_manager.try_get_state(self.RETIRED_KRY)
         if has_value:
             val: bool = p
@@ -99,12 +150,43 @@ class DistributedIndexActor(Actor, DistributedIndexInterface):
         await self.logger.shutdown()
 
     async def _on_post_actor_method(self, method_context: ActorMethodContext):
-        if self.segments is not None:
-            await self._state_manager.set_state(self.STATE_KEY, [asdict(i) for i in self.segments["obj"]])
-        await self._state_manager.set_state(self.RETIRED_KRY, self.retired)
-        await self._state_manager.set_state(self.BUFFER_KEY, [asdict(i) for i in self.cache])
+        """
+        只持久化新增的线段，只读调用不写状态
+        """
+        if not self.pending:
+            return
+        if (self.delta_size + len(self.pending) > self.snapshot_size * DELTA_COMPACTION_RATIO
+                or self.delta_entries >= DELTA_LOG_MAX_ENTRIES):
+            await self._compact()
+        else:
+            await self._state_manager.set_state(self._delta_key(self.delta_entries),
+                                                segments_to_wire(self.pending))
+            self.delta_entries += 1
+            self.delta_size += len(self.pending)
+            await self._state_manager.set_state(self.DELTA_LOG_KEY,
+                                                {"entries": self.delta_entries, "size": self.delta_size})
+        self.pending = []
+
+    async def _compact(self):
+        """
+        把索引与buffer中的全部线段写成新快照，并清空增量日志
+        """
+        snapshot = list(self.segments) + list(self.cache)
+        await self._state_manager.set_state(self.STATE_KEY, segments_to_wire(snapshot))
+        for k in range(self.delta_entries):
+            await self._state_manager.remove_state(self._delta_key(k))
+        self.snapshot_size = len(snapshot)
+        self.delta_entries = 0
+        self.delta_size = 0
+        await self._state_manager.set_state(self.DELTA_LOG_KEY, {"entries": 0, "size": 0})
 
     async def accept_new_segment(self, segment: dict) -> Tuple[bool, int]:
+        return await self._accept(segments_from_wire([segment])[0])
+
+    async def accept_packed_segment(self, data: str) -> Tuple[bool, int]:
+        return await self._accept(segments_from_wire(data)[0])
+
+    async def _accept(self, s: TrajectorySegment) -> Tuple[bool, int]:
         """
         接受一个轨迹段并先插入buffer
         """
@@ -112,73 +194,83 @@ class DistributedIndexActor(Actor, DistributedIndexInterface):
             if self.retired:
                 return False, self.resolution + 1
             async with self.lock.writer_lock:
-                s: TrajectorySegment = from_dict(TrajectorySegment, segment)
-                if self.cache:
-                    self.cache.add(s)
-                else:
-                    self.cache = {s}
-                await self._check_insertion()
+                fresh = self._buffer([s])
+                if not fresh:
+                    # 发送方超时或部分失败后整批重发的线段，已经接收过
+                    return True, self.resolution
+                self.pending.extend(fresh)
+                births = await self._check_insertion()
                 # self.logger.info(
-                #     f"Buffer: {len(self.cache) if self.cache else 0}, Tree: {len(self.segments) if self.segments is not None else 0}")
-                return True, self.resolution
+                #     f"Buffer: {len(self.cache) if self.cache else 0}, Tree: {len(self.segments)}")
+            # 子区块的初始化不占用写锁
+            await self._give_birth(births)
+            self._notify_subscribers(s)
+            return True, self.resolution
         except Exception as e:
             traceback.print_exc()
             print("!error:", str(e), e.__context__, flush=True)
             return False, self.resolution
 
-    async def _check_insertion(self):
+    async def _check_insertion(self) -> Dict[str, List[TrajectorySegment]]:
         """
-        看看是不是要进行合并
+        看看是不是要进行合并，返回分裂后待初始化的子区块
         """
         if self._need_insertion():
             await self._do_insertion()
-        await self._check_split()
+        return await self._check_split()
 
-    async def _do_insertion(self):
+    def _project(self, segments: List[TrajectorySegment]) -> np.ndarray:
         """
-        进行合并
+        批量投影到墨卡托平面，每行为(x0, y0, x1, y1)
         """
-        gdf = self._cache_to_gdf()
-        if self.segments is not None and gdf is not None:
-            self.segments = self.segments.append(gdf, ignore_index=True)
-            accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
-            await accumulator_proxy.Add()
-        elif self.segments is not None:
-            pass
-        else:
-            self.segments = gdf
-            accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
-            await accumulator_proxy.Add()
-        self.cache = set()
+        coords = np.empty((len(segments), 4), dtype=np.float64)
+        coords[:, 0], coords[:, 1] = self.transformer.transform([i.start.lng for i in segments],
+                                                                [i.start.lat for i in segments])
+        coords[:, 2], coords[:, 3] = self.transformer.transform([i.end.lng for i in segments],
+                                                                [i.end.lat for i in segments])
+        return coords
+
+    def _buffer(self, segments: List[TrajectorySegment]) -> List[TrajectorySegment]:
+        """
+        投影后放入buffer，返回新加入的线段，已在buffer或网格索引中的线段跳过
+        """
+        segments = [s for s in segments if s not in self.segments]
+        if not segments:
+            return []
+        fresh = self.cache.add_many(segments, self._project(segments))
+        for s in fresh:
+            self.trajectory_segments[s.id] += 1
+        return fresh
 
-    def _cache_to_gdf(self) -> Optional[GeoDataFrame]:
+    async def _do_insertion(self):
         """
-        buffer转成gdf
+        进行合并，buffer里已投影的线段直接插入网格索引
         """
-        # TODO: 转换墨卡托投影
-        if self.cache is not None:
-            d = [{"id": i.id, "obj": i, "geometry": LineString([self.transformer.transform(i.start.lng, i.start.lat),
-                                                                self.transformer.transform(i.end.lng, i.end.lat)])}
-                 for i
-                 in
-                 self.cache]
-            return GeoDataFrame(d, crs="EPSG:3857")
-        else:
-            return None
+        if self.cache:
+            for s, (x0, y0, x1, y1) in self.cache.items():
+                self.segments.insert(s, x0, y0, x1, y1)
+            accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
+            await accumulator_proxy.Add()
+        self.cache.clear()
 
     def _need_insertion(self) -> bool:
         return len(self.cache) > MAX_BUFFER_SIZE or (
-                self.segments is not None and (len(self.cache) / len(self.segments)) > TREE_INSERTION_THRESHOLD)
+                len(self.segments) > 0 and (len(self.cache) / len(self.segments)) > TREE_INSERTION_THRESHOLD)
 
     async def initialize_as_a_new_child_region(self, segments: List[dict]) -> bool:
+        return await self._initialize(segments_from_wire(segments))
+
+    async def initialize_with_packed_segments(self, data: str) -> bool:
+        return await self._initialize(segments_from_wire(data))
+
+    async def _initialize(self, segments: List[TrajectorySegment]) -> bool:
         """
         接受母亲那来的一堆轨迹段进行初始化
         """
-        if self.cache:
-            self.cache.update(list(map(lambda x: from_dict(TrajectorySegment, x), segments)))
-        else:
-            self.cache = set(list(map(lambda x: from_dict(TrajectorySegment, x), segments)))
-        await self._check_insertion()
+        async with self.lock.writer_lock:
+            self.pending.extend(self._buffer(segments))
+            births = await self._check_insertion()
+        await self._give_birth(births)
         return True
 
     async def query(self, wkt_string: str) -> Tuple[bool, List[int]]:
@@ -193,58 +285,123 @@ class DistributedIndexActor(Actor, DistributedIndexInterface):
         res = set()
         mbr_polygon = wkt.loads(wkt_string)
         async with self.lock.reader_lock:
-            if self.segments is not None:
-                ids = self.segments.sindex.query(mbr_polygon)
-                if len(ids) > 0:
-                    res.update(self.segments.iloc[list(ids)]["id"])
-            if self.cache:
-                for i in self.cache:
-                    if mbr_polygon.intersects(
-                            LineString([self.transformer.transform(i.start.lng, i.start.lat),
-                                        self.transformer.transform(i.end.lng, i.end.lat)])):
-                        res.add(i.id)
+            res.update(self.segments.query(mbr_polygon))
+            res.update(self.cache.query(mbr_polygon))
             return True, list(res)
 
-    async def _check_split(self):
+    async def query_with_counts(self, wkt_string: str) -> Tuple[bool, Dict[str, int]]:
         """
-        查看是否要分裂
+        与query相同，同时返回各候选轨迹在本分区的线段数
         """
-        if await self._need_split():
-            await self._do_insertion()
-            await self.logger.info(
-                f"Buffer: {len(self.cache) if self.cache else 0}, Tree: {len(self.segments) if self.segments is not None else 0}")
-            # 1. 切分数据到16个子区块
-            children_resolution: int = self.resolution + 1
-            children: set = self.split_h3_area(self.h, children_resolution)
-            buckets: Dict[str, List[TrajectorySegment]] = defaultdict(lambda: list())
-            for s in self.segments["obj"]:
-                start: TrajectoryPoint = s.start
-                end: TrajectoryPoint = s.end
-                start_h = h3.geo_to_h3(start.lat, start.lng, children_resolution)
-                end_h = h3.geo_to_h3(end.lat, end.lng, children_resolution)
-                if start_h in children:  # lat,lng
-                    buckets[start_h].append(s)
-                if end_h in children:
-                    buckets[end_h].append(s)
-
-            # 3. 更新meta服务
-            data = {
-                "mother": self.id.id,
-                "children": list(children)
-            }
-
-            if "8031fffffffffff" in children:
-                await self.logger.warn("SHITTTTTTTTTTTTT")
-            meta_proxy = ActorProxy.create('IndexMetaActor', ActorId("0"), IndexMetaInterface)
-            resp: str = await meta_proxy.RegionSplit(data)
-            self.retired = True
-            await self._state_manager.set_state(self.RETIRED_KRY, self.retired)
-            await self._state_manager.save_state()
-
-            # 2. 初始化16个子区块
-            for k, v in buckets.items():
-                await self._childbirth(k, v)
-            await self.logger.info(f"{resp}, I'm retired")
+        _, res = await self.query(wkt_string)
+        return True, {tid: self.trajectory_segments.get(tid, 0) for tid in res}
+
+    async def _check_split(self) -> Dict[str, List[TrajectorySegment]]:
+        """
+        查看是否要分裂，分裂则退役并返回各子区块要接收的线段
+        """
+        if not await self._need_split():
+            return {}
+        self.split_started = time.perf_counter()
+        await self._do_insertion()
+        await self.logger.info(
+            f"Buffer: {len(self.cache) if self.cache else 0}, Tree: {len(self.segments)}")
+        # 1. 切分数据到子区块
+        children_resolution: int = self.resolution + 1
+        children: Set[str] = self.split_h3_area(self.h, children_resolution)
+        buckets = self._bucket_by_children(children_resolution, children)
+
+        # 3. 更新meta服务
+        data = {
+            "mother": self.id.id,
+            "children": list(children)
+        }
+        resp: List[str] = await asyncio.gather(*[meta_proxy(shard).RegionSplit(data)
+                                                 for shard in region_shards(self.h)])
+        self.retired = True
+        await self._state_manager.set_state(self.RETIRED_KRY, self.retired)
+        await self._state_manager.save_state()
+        await self.logger.info(f"{resp}, I'm retired")
+        return buckets
+
+    def _bucket_by_children(self, children_resolution: int, children: Set[str]) -> Dict[str, List[TrajectorySegment]]:
+        """
+        向量化计算所有端点所在的子网格(整数编号)，排序后按子网格分组，再取出各子区块的线段
+        """
+        segments: List[TrajectorySegment] = list(self.segments)
+        if not segments:
+            return {}
+        n = len(segments)
+        lat_lng = np.array([(s.start.lat, s.start.lng, s.end.lat, s.end.lng) for s in segments]).reshape(-1, 2)
+        cells = h3_vect.geo_to_h3(lat_lng[:, 0], lat_lng[:, 1], children_resolution).reshape(-1, 2)
+        # 每条线段归入起点与终点所在的子网格，两端同一子网格时只归入一次
+        crossing = np.flatnonzero(cells[:, 0] != cells[:, 1])
+        keys = np.concatenate([cells[:, 0], cells[crossing, 1]])
+        owners = np.concatenate([np.arange(n), crossing])
+        order = np.argsort(keys, kind="stable")
+        keys, owners = keys[order], owners[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        buckets: Dict[str, List[TrajectorySegment]] = {}
+        for key, group in zip(keys[starts].tolist(), np.split(owners, starts[1:])):
+            child = h3.h3_to_string(key)
+            if child in children:
+                buckets[child] = [segments[i] for i in np.sort(group)]
+        return buckets
+
+    async def _give_birth(self, buckets: Dict[str, List[TrajectorySegment]]) -> None:
+        """
+        2. 并发初始化各子区块，并报告分裂耗时与搬移的数据量
+        """
+        if not buckets:
+            return
+        payloads: Dict[str, bytes] = {
+            h: self.runtime_ctx.message_serializer.serialize(segments_to_wire(v)) for h, v in buckets.items()
+        }
+        await asyncio.gather(*[self._childbirth(h, payload) for h, payload in payloads.items()])
+        # 持续查询的订阅转交给所有子区块，之后落入子区块的线段照常通知
+        children: Set[str] = self.split_h3_area(self.h, self.resolution + 1)
+        await asyncio.gather(*[
+            ActorProxy.create('DistributedIndexActor', ActorId(h), DistributedIndexInterface).Subscribe(
+                {"query": q, "wkt": w}) for h in children for q, w in self.subscriptions.items()])
+        # 告知持续查询新的子分区，使其注销或范围变化时一并退订
+        notify_standing_queries(list(self.subscriptions), [], children)
+        await self.logger.info(
+            f"Split into {len(buckets)} children, moved {sum(map(len, buckets.values()))} segments, "
+            f"{sum(map(len, payloads.values()))} bytes, using: {time.perf_counter() - self.split_started}s")
+
+    async def subscribe(self, data: dict) -> bool:
+        """
+        持续查询订阅本分区，与其查询范围相交的新线段会通知该查询
+        """
+        self.subscriptions[data["query"]] = data["wkt"]
+        self.subscription_areas[data["query"]] = prep(wkt.loads(data["wkt"]))
+        await self._state_manager.set_state(self.SUBSCRIPTIONS_KEY, self.subscriptions)
+        return True
+
+    async def unsubscribe(self, query: str) -> bool:
+        if query not in self.subscriptions:
+            return False
+        del self.subscriptions[query]
+        del self.subscription_areas[query]
+        await self._state_manager.set_state(self.SUBSCRIPTIONS_KEY, self.subscriptions)
+        return True
+
+    def _notify_subscribers(self, segment: TrajectorySegment) -> None:
+        if not self.subscriptions:
+            return
+        x0, y0, x1, y1 = self._project([segment])[0]
+        line = LineString([(x0, y0), (x1, y1)])
+        notify_standing_queries([q for q, area in self.subscription_areas.items() if area.intersects(line)],
+                                [segment.id])
+
+    @staticmethod
+    def grid_cell_size(h: str) -> float:
+        """
+        按分区分辨率确定格子边长，H3边长为地面米，按分区中心纬度换算成墨卡托米
+        """
+        lat, _ = h3.h3_to_geo(h)
+        edge = h3.edge_length(h3.h3_get_resolution(h), unit="m") / math.cos(math.radians(lat))
+        return min(GRID_CELL_SIZE, GRID_CELL_EDGE_RATIO * edge)
 
     @staticmethod
     def split_h3_area(h: str, resolution: int) -> Set[str]:
@@ -255,12 +412,12 @@ class DistributedIndexActor(Actor, DistributedIndexInterface):
         return h3.k_ring(center, 2)
 
     @staticmethod
-    async def _childbirth(h: str, segments: List[TrajectorySegment]) -> bool:
+    async def _childbirth(h: str, payload: bytes) -> bool:
         proxy = ActorProxy.create('DistributedIndexActor', ActorId(h), DistributedIndexInterface)
-        return await proxy.InitializeAsANewChildRegion(list(map(asdict, segments)))
+        return await proxy.InitializeWithPackedSegments(payload)
 
     async def _need_split(self) -> bool:
-        ratio = len(self.segments) if self.segments is not None else 0
+        ratio = len(self.segments)
         if self.resolution == 15 and not self.full:
             await self.logger.critical(f"{self.id.id}_No more cells left")
             self.full = True
@@ -0,0 +1,148 @@
+import math
+from collections import defaultdict
+from itertools import chain
+from typing import Dict, List, Set, Tuple, Iterator, Iterable
+
+import numpy as np
+from shapely.geometry import LineString
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+
+from interfaces.types import TrajectorySegment
+
+Cell = Tuple[int, int]
+
+
+class SegmentGrid:
+    """
+    墨卡托平面上的均匀网格动态索引，线段直接插入而无需重建整棵树
+    """
+    # 覆盖网格数超过该值的长线段单独存放，查询时总是检查
+    MAX_CELLS_PER_SEGMENT = 64
+
+    def __init__(self, cell_size: float):
+        self.cell_size: float = cell_size
+        self.cells: Dict[Cell, List[int]] = defaultdict(list)
+        self.large: List[int] = []
+        self.segments: List[TrajectorySegment] = []
+        self.lines: List[LineString] = []
+        # 已插入的线段，重发的线段不会重复插入
+        self.members: Set[TrajectorySegment] = set()
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def __iter__(self) -> Iterator[TrajectorySegment]:
+        return iter(self.segments)
+
+    def __contains__(self, segment: TrajectorySegment) -> bool:
+        return segment in self.members
+
+    def _cell_range(self, min_x: float, min_y: float, max_x: float, max_y: float) -> Tuple[int, int, int, int]:
+        s = self.cell_size
+        return math.floor(min_x / s), math.floor(min_y / s), math.floor(max_x / s), math.floor(max_y / s)
+
+    def insert(self, segment: TrajectorySegment, x0: float, y0: float, x1: float, y1: float) -> bool:
+        """
+        插入一条已投影到墨卡托平面的线段，已在索引中的线段直接跳过并返回False
+        """
+        if segment in self.members:
+            return False
+        i = len(self.segments)
+        self.segments.append(segment)
+        self.members.add(segment)
+        self.lines.append(LineString([(x0, y0), (x1, y1)]))
+        cx0, cy0, cx1, cy1 = self._cell_range(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > self.MAX_CELLS_PER_SEGMENT:
+            self.large.append(i)
+            return True
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                self.cells[(cx, cy)].append(i)
+        return True
+
+    def _candidate_cells(self, bounds: Tuple[float, float, float, float]) -> Iterable[Cell]:
+        cx0, cy0, cx1, cy1 = self._cell_range(*bounds)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(self.cells):
+            return (c for c in ((cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1))
+                    if c in self.cells)
+        # 查询范围比已占用的网格还多，直接扫描已占用的网格
+        return (c for c in self.cells if cx0 <= c[0] <= cx1 and cy0 <= c[1] <= cy1)
+
+    def query(self, geometry: BaseGeometry) -> Set[str]:
+        """
+        返回与给定几何相交的线段所属的轨迹id
+        """
+        res: Set[str] = set()
+        if not self.segments:
+            return res
+        prepared = prep(geometry)
+        candidates: Set[int] = set(chain.from_iterable(self.cells[c] for c in self._candidate_cells(geometry.bounds)))
+        for i in chain(candidates, self.large):
+            tid = self.segments[i].id
+            if tid not in res and prepared.intersects(self.lines[i]):
+                res.add(tid)
+        return res
+
+
+class SegmentBuffer:
+    """
+    插入缓冲：线段与其预先投影好的墨卡托坐标按列存放，查询时向量化筛选
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.segments: List[TrajectorySegment] = []
+        self.members: Set[TrajectorySegment] = set()
+        # 每行为(x0, y0, x1, y1)
+        self.coords: np.ndarray = np.empty((capacity, 4), dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def __iter__(self) -> Iterator[TrajectorySegment]:
+        return iter(self.segments)
+
+    def __contains__(self, segment: TrajectorySegment) -> bool:
+        return segment in self.members
+
+    def add_many(self, segments: List[TrajectorySegment], coords: np.ndarray) -> List[TrajectorySegment]:
+        """
+        加入已投影的线段，返回此前不在buffer中的线段
+        """
+        fresh = []
+        for s, c in zip(segments, coords):
+            if s in self.members:
+                continue
+            n = len(self.segments)
+            if n == len(self.coords):
+                self.coords = np.concatenate([self.coords, np.empty_like(self.coords)])
+            self.coords[n] = c
+            self.segments.append(s)
+            self.members.add(s)
+            fresh.append(s)
+        return fresh
+
+    def items(self) -> Iterator[Tuple[TrajectorySegment, np.ndarray]]:
+        return zip(self.segments, self.coords[:len(self.segments)])
+
+    def clear(self) -> None:
+        self.segments = []
+        self.members = set()
+
+    def query(self, geometry: BaseGeometry) -> Set[str]:
+        """
+        先用包围盒向量化预筛，再对剩余线段做精确相交判断
+        """
+        res: Set[str] = set()
+        if not self.segments:
+            return res
+        c = self.coords[:len(self.segments)]
+        min_x, min_y, max_x, max_y = geometry.bounds
+        mask = ((np.minimum(c[:, 0], c[:, 2]) <= max_x) & (np.maximum(c[:, 0], c[:, 2]) >= min_x)
+                & (np.minimum(c[:, 1], c[:, 3]) <= max_y) & (np.maximum(c[:, 1], c[:, 3]) >= min_y))
+        prepared = prep(geometry)
+        for i in np.flatnonzero(mask):
+            tid = self.segments[i].id
+            if tid not in res and prepared.intersects(LineString([c[i, :2], c[i, 2:]])):
+                res.add(tid)
+        return res
@@ -2,7 +2,8 @@ import json
 import time
 import traceback
 import warnings
-from typing import Optional, List
+from collections import deque
+from typing import Optional, List, Deque, Tuple, Set, Dict
 
 from aiologger.formatters.base import Formatter
 from pyproj import Transformer
@@ -16,32 +17,44 @@ import h3
 import numpy as np
 from aiologger import Logger
 from aiologger.levels import LogLevel
-from dacite import from_dict
 from dapr.actor import Actor, ActorId, ActorProxy
 from dapr.actor.runtime.context import ActorRuntimeContext
 from geopandas import GeoDataFrame
 from shapely.geometry import box, Polygon
 
+from index_meta.shard import point_shard
 from interfaces.index_meta_interface import IndexMetaInterface
-from interfaces.types import TrajectoryPoint
+from interfaces.codec import points_from_wire
 
 import aiorwlock
 
 BOSS = h3.get_res0_indexes()
 
 with open("tests/parameters.json") as f:
-    INIT_RESOLUTION = json.load(f)["INIT_RESOLUTION"]
+    para: dict = json.load(f)
+    INIT_RESOLUTION = para["INIT_RESOLUTION"]
+    # 保留的分裂记录数量，落后更多的路由缓存需要整体清空
+    SPLIT_LOG_SIZE = para.get("SPLIT_LOG_SIZE", 1024)
 
 print(f"{INIT_RESOLUTION=}", flush=True)
+print(f"{SPLIT_LOG_SIZE=}", flush=True)
 
 
 class IndexMetaActor(Actor, IndexMetaInterface):
     def __init__(self, ctx: ActorRuntimeContext, actor_id: ActorId):
         super().__init__(ctx, actor_id)
 
-        # self.gdf: Optional[GeoDataFrame] = GeoDataFrame(
-        #     [{"h": h, "geometry": IndexMetaActor.h3_to_box(h)} for h in BOSS])
+        # 存活的分区，点路由按H3层级逐级探测
+        self.live: Set[str] = set()
+        # 已分裂退役的分区
+        self.retired: Set[str] = set()
+        # 各分辨率上存活分区的数量，只探测有分区的层级
+        self.resolutions: Dict[int, int] = {}
+
+        # 仅供agent_query使用的墨卡托外包框，分区变化后按需重建
+        self.boxes: Dict[str, Polygon] = {}
         self.gdf: Optional[GeoDataFrame] = None
+        self.dirty: bool = False
 
         # 球面坐标转墨卡托平面投影
         self.transformer = Transformer.from_crs(4326, 3857, always_xy=True)
@@ -51,37 +64,51 @@ class IndexMetaActor(Actor, IndexMetaInterface):
 
         self.locker = aiorwlock.RWLock()
 
-    async def _is_region_retired(self, h: str) -> bool:
-        has_value, _ = await self._state_manager.try_get_state(f"DistributedIndexActor_{h}_retired")
-        # await self.logger.info(f"{h} retired but queried")
-        return has_value
+        # 每次分裂纪元加一，并记录退役的母区块以便路由缓存失效
+        self.epoch: int = 0
+        self.split_log: Deque[Tuple[int, str]] = deque(maxlen=SPLIT_LOG_SIZE)
+
+    def _add_region(self, h: str) -> None:
+        if h in self.live:
+            return
+        self.live.add(h)
+        r = h3.h3_get_resolution(h)
+        self.resolutions[r] = self.resolutions.get(r, 0) + 1
+        self.boxes[h] = self.h3_to_box(h)
+        self.dirty = True
+
+    def _remove_region(self, h: str) -> None:
+        if h not in self.live:
+            return
+        self.live.remove(h)
+        r = h3.h3_get_resolution(h)
+        self.resolutions[r] -= 1
+        if self.resolutions[r] == 0:
+            del self.resolutions[r]
+        del self.boxes[h]
+        self.dirty = True
 
     async def region_split(self, data: dict) -> str:
         async with self.locker.writer_lock:
             try:
                 start = time.perf_counter()
-                children: List[str] = []
-                for h in data["children"]:
-                    is_retired = await self._is_region_retired(h)
-                    if not is_retired:
-                        children.append(h)
-                new_data = GeoDataFrame([
-                    {
-                        "h": i,
-                        "geometry": self.h3_to_box(i)
-                    }
-                    for i in children
-                ], crs="EPSG:3857")
-                self.gdf = self.gdf.loc[self.gdf["h"] != data["mother"]]
-                self.gdf = self.gdf.append(new_data, ignore_index=True) if self.gdf is not None else GeoDataFrame(
-                    new_data)
-                self.gdf.drop_duplicates().reset_index(drop=True)
+                if data["mother"] not in self.live:
+                    # 分裂会广播到可能登记了母区块的所有分片，本分片未登记则只记下退役
+                    self.retired.add(data["mother"])
+                    return 'SPLIT_RECEIVED'
+                children: List[str] = [h for h in data["children"] if h not in self.retired]
+                self._remove_region(data["mother"])
+                self.retired.add(data["mother"])
+                for h in children:
+                    self._add_region(h)
+                self.epoch += 1
+                self.split_log.append((self.epoch, data["mother"]))
                 accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
                 await accumulator_proxy.MetaAdd()
                 # if "8031fffffffffff" in data['children'] or "8031fffffffffff" == data['mother']:
                 await self.logger.info(
-                    f"Split {data['mother']} to {children},len:{len(self.gdf)}, using: {time.perf_counter() - start}s")
-                # self.logger.info(f"len:{len(self.gdf)}")
+                    f"Split {data['mother']} to {children},len:{len(self.live)}, using: {time.perf_counter() - start}s")
+                # self.logger.info(f"len:{len(self.live)}")
 
                 return 'SPLIT_RECEIVED'
             except Exception as e:
@@ -90,48 +117,47 @@ class IndexMetaActor(Actor, IndexMetaInterface):
                 print("error:", str(e), flush=True)
                 return ""
 
+    def _probe(self, lng: float, lat: float) -> List[str]:
+        """
+        逐个分辨率探测点所在的H3网格是否为存活分区
+        """
+        found = []
+        for r in self.resolutions:
+            h = h3.geo_to_h3(lat, lng, r)
+            if h in self.live:
+                found.append(h)
+        return found
+
+    def _orphan(self, lng: float, lat: float) -> str:
+        """
+        为不属于任何分区的点新建分区，初始分辨率的网格已退役时取更细的网格
+        """
+        r = INIT_RESOLUTION
+        h = h3.geo_to_h3(lat, lng, r)
+        while h in self.retired and r < 15:
+            r += 1
+            h = h3.geo_to_h3(lat, lng, r)
+        self._add_region(h)
+        return h
+
+    async def _locate(self, lng: float, lat: float) -> List[str]:
+        """
+        查找点所在的分区，没有则按初始分辨率新建一个
+        """
+        found = self._probe(lng, lat)
+        if found:
+            return found
+        # await self.logger.info(f"{lng},{lat} is orphan")
+        h = self._orphan(lng, lat)
+        accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
+        await accumulator_proxy.MetaAdd()
+        return [h]
+
     async def query(self, data: dict) -> List[str]:
         try:
-            start = from_dict(TrajectoryPoint, data["start"])
-            end = from_dict(TrajectoryPoint, data["end"])
-            start_lng, start_lat = start.lng, start.lat
-            end_lng, end_lat = end.lng, end.lat
-            async with self.locker.reader_lock:
-                start_res = self.gdf.sindex.query(
-                    box(start_lng, start_lat, start_lng, start_lat)) if self.gdf is not None else []
-
-            res = set()
-            if len(start_res) == 0:
-                # await self.logger.info(f"start:{start} is orphan")
-                h = h3.geo_to_h3(start_lat, start_lng, INIT_RESOLUTION)
-                # if h == "8031fffffffffff":
-                #     await self.logger.warn("Spotted in start")
-                other = GeoDataFrame([{"h": h, "geometry": self.h3_to_box(h)}], crs="EPSG:3857")
-                async with self.locker.writer_lock:
-                    self.gdf = self.gdf.append(other, ignore_index=True) if self.gdf is not None else other
-                    accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
-                    await accumulator_proxy.MetaAdd()
-                res.add(h)
-            else:
-                async with self.locker.writer_lock:
-                    res.update(list(self.gdf.iloc[list(start_res)]["h"]))
-            async with self.locker.reader_lock:
-                end_res = self.gdf.sindex.query(box(end_lng, end_lat, end_lng, end_lat)) if self.gdf is not None else []
-            if len(end_res) == 0:
-                # await self.logger.info(f"end:{start} is orphan")
-
-                h = h3.geo_to_h3(end_lat, end_lng, INIT_RESOLUTION)
-                if h == "8031fffffffffff":
-                    await self.logger.warn("Spotted in end")
-                other = GeoDataFrame([{"h": h, "geometry": self.h3_to_box(h)}], crs="EPSG:3857")
-                async with self.locker.writer_lock:
-                    self.gdf = self.gdf.append(other, ignore_index=True) if self.gdf is not None else other
-                    accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
-                    await accumulator_proxy.MetaAdd()
-                res.add(h)
-            else:
-                async with self.locker.writer_lock:
-                    res.update(list(self.gdf.iloc[list(end_res)]["h"]))
+            start, end = points_from_wire([data["start"], data["end"]])
+            res = set(await self._locate(start.lng, start.lat))
+            res.update(await self._locate(end.lng, end.lat))
             # self.logger.info(f"\nQuery found:{res},{start},{end}\n{self.gdf}\n")
             return list(res)
         except Exception as e:
@@ -140,11 +166,63 @@ class IndexMetaActor(Actor, IndexMetaInterface):
             print("error:", str(e), flush=True)
             return []
 
+    def _retired_since(self, known_epoch: int) -> Optional[List[str]]:
+        """
+        调用方纪元之后退役的区块，协调者重启过或分裂记录已不完整时返回None，调用方需要清空缓存
+        """
+        if known_epoch > self.epoch or (self.split_log and known_epoch < self.split_log[0][0] - 1):
+            return None
+        return [mother for epoch, mother in self.split_log if epoch > known_epoch]
+
+    async def query_many(self, data: dict) -> dict:
+        """
+        批量查询线段端点所在的分区，孤立点一次性新建分区
+
+        返回分区表与每条线段起点、终点所在分区在表中的下标，并附带纪元信息供路由缓存失效，
+        不归本分片负责的端点返回空列表
+        """
+        try:
+            segments = np.asarray(data["segments"], dtype=np.float64).reshape(-1, 4)
+            table: Dict[str, int] = {}
+            located: Dict[Tuple[float, float], List[int]] = {}
+            orphans = 0
+            for lng, lat in segments.reshape(-1, 2).tolist():
+                if (lng, lat) in located:
+                    continue
+                if point_shard(lng, lat) != self.id.id:
+                    located[(lng, lat)] = []
+                    continue
+                found = self._probe(lng, lat)
+                if not found:
+                    found = [self._orphan(lng, lat)]
+                    orphans += 1
+                located[(lng, lat)] = [table.setdefault(h, len(table)) for h in found]
+            if orphans:
+                accumulator_proxy = ActorProxy.create('AccumulatorActor', ActorId("0"), AccumulatorInterface)
+                await accumulator_proxy.MetaAddMany(orphans)
+            return {
+                "regions": list(table.keys()),
+                "segments": [[located[(slng, slat)], located[(elng, elat)]]
+                             for slng, slat, elng, elat in segments.tolist()],
+                "epoch": self.epoch,
+                "retired": self._retired_since(data.get("epoch", -1))
+            }
+        except Exception as e:
+            await self.logger.info("query many failed")
+            traceback.print_tb(e.__traceback__)
+            print("error:", str(e), flush=True)
+            return {"regions": [], "segments": [], "epoch": self.epoch, "retired": None}
+
     async def agent_query(self, wkt_string: str) -> List[str]:
-        async with self.locker.reader_lock:
-            p: Polygon = wkt.loads(wkt_string)
-            res = self.gdf.sindex.query(p) if self.gdf is not None else []
-            return list(set(self.gdf.iloc[list(res)]["h"]))
+        p: Polygon = wkt.loads(wkt_string)
+        if self.dirty:
+            self.gdf = GeoDataFrame({"h": list(self.boxes.keys())}, geometry=list(self.boxes.values()),
+                                    crs="EPSG:3857") if self.boxes else None
+            self.dirty = False
+        if self.gdf is None:
+            return []
+        res = self.gdf.sindex.query(p)
+        return list(set(self.gdf.iloc[list(res)]["h"]))
 
     def h3_to_box(self, h: str) -> box:
         # TODO:墨卡托投影
@@ -0,0 +1,66 @@
+import json
+from itertools import chain
+from typing import Set
+
+import h3
+from dapr.actor import ActorProxy, ActorId
+from pyproj import Transformer
+from shapely.geometry import Polygon
+
+from interfaces.index_meta_interface import IndexMetaInterface
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 协调者按该分辨率的H3网格分片，负数则只有一个分片"0"
+    META_SHARD_RESOLUTION = para.get("META_SHARD_RESOLUTION", 0)
+
+print(f"{META_SHARD_RESOLUTION=}", flush=True)
+
+# 墨卡托平面投影转回球面坐标
+_to_lnglat = Transformer.from_crs(3857, 4326, always_xy=True)
+
+
+def meta_proxy(shard: str) -> IndexMetaInterface:
+    return ActorProxy.create('IndexMetaActor', ActorId(shard), IndexMetaInterface)
+
+
+def point_shard(lng: float, lat: float) -> str:
+    """
+    点的路由由其所在网格的分片负责
+    """
+    if META_SHARD_RESOLUTION < 0:
+        return "0"
+    return h3.geo_to_h3(lat, lng, META_SHARD_RESOLUTION)
+
+
+def _with_neighbors(shards: Set[str]) -> Set[str]:
+    # H3子网格并不严格落在父网格内，分区与查询范围都可能越过分片边界
+    return set(chain.from_iterable(h3.k_ring(s, 1) for s in shards))
+
+
+def region_shards(h: str) -> Set[str]:
+    """
+    可能登记了该分区的分片，分裂时需要逐个通知
+    """
+    if META_SHARD_RESOLUTION < 0:
+        return {"0"}
+    resolution = h3.h3_get_resolution(h)
+    if resolution < META_SHARD_RESOLUTION:
+        shards = set(h3.h3_to_children(h, META_SHARD_RESOLUTION))
+    else:
+        shards = {h3.h3_to_parent(h, META_SHARD_RESOLUTION)}
+    return _with_neighbors(shards)
+
+
+def polygon_shards(polygon: Polygon) -> Set[str]:
+    """
+    与墨卡托平面上的查询范围相交的分片
+    """
+    if META_SHARD_RESOLUTION < 0:
+        return {"0"}
+    xs, ys = polygon.exterior.coords.xy
+    lngs, lats = _to_lnglat.transform(xs, ys)
+    shards = {h3.geo_to_h3(lat, lng, META_SHARD_RESOLUTION) for lng, lat in zip(lngs, lats)}
+    shards.update(h3.polyfill({"type": "Polygon", "coordinates": [list(zip(lngs, lats))]},
+                              META_SHARD_RESOLUTION, geo_json_conformant=True))
+    return _with_neighbors(shards)
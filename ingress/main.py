@@ -4,9 +4,9 @@ import os
 import sys
 import time
 import traceback
-from dataclasses import asdict
 from datetime import datetime
-from typing import List, Dict
+from itertools import groupby, islice
+from typing import List, Dict, Iterable, Iterator
 
 from asyncio_throttle import Throttler
 from dapr.actor import ActorProxy, ActorId
@@ -15,9 +15,11 @@ from split import chop
 
 sys.path.append(os.curdir)
 from interfaces.accumulator_interface import AccumulatorInterface
+from interfaces.codec import points_to_wire
 
 from interfaces.trajectory_assembler_interface import TrajectoryAssemblerInterface
 from interfaces.types import TrajectoryPoint
+from ingress.replay import INGRESS_BATCH_SIZE, replay
 
 
 def str_to_TrajectoryPoint(s: str) -> TrajectoryPoint:
@@ -37,49 +39,24 @@ def str_to_TrajectoryPoint(s: str) -> TrajectoryPoint:
         )
 
 
-async def send_one_point(s: str, id: int) -> bool:
+def group_consecutive(points: Iterable[TrajectoryPoint], batch_size: int) -> Iterator[List[TrajectoryPoint]]:
+    """
+    将同一轨迹id的连续轨迹点分组，每组最多batch_size个
+    """
+    for _, group in groupby(points, key=lambda p: p.id):
+        while batch := list(islice(group, batch_size)):
+            yield batch
+
+
+async def send_points(points: List[TrajectoryPoint], id: str) -> bool:
     while True:
         try:
-            p: TrajectoryPoint = str_to_TrajectoryPoint(s)
-            proxy = ActorProxy.create('TrajectoryAssemblerActor', ActorId(str(id)), TrajectoryAssemblerInterface)
-            return await proxy.AcceptNewPoint(asdict(p))
-
+            proxy = ActorProxy.create('TrajectoryAssemblerActor', ActorId(id), TrajectoryAssemblerInterface)
+            return await proxy.AcceptPackedPoints(points_to_wire(points))
         except Exception as e:
             traceback.print_exc()
             print(f"sleeping: {e}", flush=True)
-            time.sleep(1)
-            continue
-
-
-async def worker(id: int, throttler: Throttler):
-    try:
-        print("sending", id, flush=True)
-        with open(f"data/filtered/{id}.txt", 'r', encoding="utf-8") as f:
-            s = f.readline()
-            while s:
-                async with throttler:
-                    resp = await send_one_point(s, id)
-                c = 1
-                while not resp:
-                    await asyncio.sleep(0.01)
-                    resp = await send_one_point(s, id)
-                    c += 1
-                    if c % 10 == 0:
-                        print(f"{id}: tried for {c} times!", flush=True)
-                s = f.readline()
-        print(id, " done", flush=True)
-        return 0
-    except Exception as e:
-        print(id, "failed", flush=True)
-        print(e, flush=True)
-        return 1
-
-
-def run_loop(ids: List[int]):
-    throttler = Throttler(rate_limit=60000, period=60, retry_interval=0.0001)
-    loop = asyncio.get_event_loop()
-    loops = [loop.create_task(worker(i, throttler)) for i in ids]
-    loop.run_until_complete(asyncio.wait(loops))
+            await asyncio.sleep(1)
 
 
 async def single_process():
@@ -87,25 +64,22 @@ async def single_process():
     with open("data/four.txt", 'r', encoding="utf-8") as f:
         start = time.perf_counter()
         lines = f.readlines()
-        for line in lines:
-            p: TrajectoryPoint = str_to_TrajectoryPoint(line)
+        points = map(str_to_TrajectoryPoint, lines)
+        for batch in group_consecutive(points, INGRESS_BATCH_SIZE):
             async with throttler:
-                proxy = ActorProxy.create('TrajectoryAssemblerActor', ActorId(str(p.id)), TrajectoryAssemblerInterface)
-                await proxy.AcceptNewPoint(asdict(p))
+                await send_points(batch, str(batch[0].id))
         end = time.perf_counter()
         print(
             f"using: {end - start}s,{len(lines)} p,{len(lines) / (end - start)} p/s, {(end - start) / len(lines)} s/p")
 
 
 async def run_a_batch(fnames: List[int], res_fname: str, start: float):
-    throttler = Throttler(rate_limit=60000, period=60, retry_interval=0.0001)
-    # pool = multiprocessing.Pool(processes=20)
-    # pool.imap_unordered(run_loop, chop(1, fnames))
     # p = subprocess.Popen(f"python3 ingress/query_sampler.py {res_fname}_{min(fnames)}_{max(fnames)}", shell=True)
     # p2 = subprocess.Popen(f"python3 ingress/mytop.py {res_fname}_{min(fnames)}_{max(fnames)}", shell=True)
-    await asyncio.gather(*[worker(i, throttler) for i in fnames])
-    # pool.close()
-    # pool.join()
+    # 多进程回放，不占用本进程的事件循环
+    replayed = await asyncio.get_running_loop().run_in_executor(None, replay, fnames)
+    for r in replayed["workers"]:
+        print(r, flush=True)
     # p.kill()
     # p2.kill()
     end = time.perf_counter()
@@ -119,19 +93,17 @@ async def run_a_batch(fnames: List[int], res_fname: str, start: float):
     tree_counter, meta_counter = counter["tree"], counter["meta"]
     # res = []
     # for i in fnames:
-    #     resp = get(f"http://localhost:3302/query-with-id/{i}?threshold=100000&batch_size=2")
+    #     resp = get(f"http://localhost:3302/query-with-id/{i}?threshold=100000")
     #     res.append(resp.json())
     # end2 = time.perf_counter()
     # print(f"query using: {end - start}s")
     # t2 = end2 - start2
 
-    total_points = 0
-    for f in fnames:
-        with open(f"data/filtered/{f}.txt") as fp:
-            total_points += len(fp.readlines())
+    total_points = replayed["points"]
     with open(f"tests/results/{res_fname}_{min(fnames)}_{max(fnames)}.json", "w") as f:
         json.dump({"insertion_time": t1, "tps": total_points / t1,
-                   "latency": t1 / total_points, "tree_counter": tree_counter, "meta_counter": meta_counter}, f)
+                   "latency": t1 / total_points, "tree_counter": tree_counter, "meta_counter": meta_counter,
+                   "replay": replayed}, f)
     return t1, tree_counter, meta_counter, time.time()
 
 
@@ -143,7 +115,7 @@ async def run_test(fnames: List[int], res_fname: str):
     for idx, batch in enumerate(batches):
         t1, tree_counter, meta_counter, t = await run_a_batch(batch, res_fname, start)
         # query test
-        resp = get(f"http://localhost:3302/query-with-id/1?threshold=10000&batch_size=2")
+        resp = get(f"http://localhost:3302/query-with-id/1?threshold=10000")
         res[(idx + 1) * batch_size] = {"insertion_time": t1, "tree_counter": tree_counter,
                                        "meta_counter": meta_counter, "resp": resp.json(), "t": t}
     return res
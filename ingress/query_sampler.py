@@ -29,7 +29,7 @@ async def loop_task(arg):
     while True:
         # if killer.is_kill_now:
         #     break
-        resp = get(f"http://localhost:3302/query-with-id/1?threshold=100000&batch_size=2")
+        resp = get(f"http://localhost:3302/query-with-id/1?threshold=100000")
         with open(f"tests/results/{arg[1]}_query_{time.time()}.json", 'w') as f:
             json.dump(resp.json(), f)
         await asyncio.sleep(60)
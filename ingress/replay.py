@@ -0,0 +1,352 @@
+import asyncio
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import List, Tuple, Iterator, Optional
+
+import numpy as np
+from asyncio_throttle import Throttler
+from dapr.actor import ActorProxy, ActorId
+
+sys.path.append(os.curdir)
+from interfaces.codec import encode_trajectory
+from interfaces.packed import to_wire
+from interfaces.trajectory_assembler_interface import TrajectoryAssemblerInterface
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 每次请求发送的连续轨迹点数量，1为逐点发送
+    INGRESS_BATCH_SIZE = para.get("INGRESS_BATCH_SIZE", 1)
+    # 回放进程数，默认为本机核数
+    REPLAY_WORKERS = para.get("REPLAY_WORKERS", os.cpu_count())
+    # 每个回放进程同时发送的轨迹数，同一轨迹的点总是依次发送
+    REPLAY_CONCURRENCY = para.get("REPLAY_CONCURRENCY", 64)
+    # 所有回放进程合计每秒的请求数上限，0为不限速
+    REPLAY_RATE_LIMIT = para.get("REPLAY_RATE_LIMIT", 0)
+    # 失败重试的最长等待秒数，等待时间从0.01秒起按倍数增长
+    REPLAY_MAX_BACKOFF = para.get("REPLAY_MAX_BACKOFF", 5)
+    # 各回放进程报告进度的间隔秒数
+    REPLAY_REPORT_INTERVAL = para.get("REPLAY_REPORT_INTERVAL", 10)
+    # 按事件时间回放的加速倍数，0为不按时间尽快发送
+    REPLAY_SPEEDUP = para.get("REPLAY_SPEEDUP", 0)
+    # 按事件时间回放时，所有回放进程解析完数据后再等待的秒数
+    REPLAY_START_DELAY = para.get("REPLAY_START_DELAY", 1)
+
+print(f"{INGRESS_BATCH_SIZE=}", flush=True)
+print(f"{REPLAY_WORKERS=}", flush=True)
+print(f"{REPLAY_CONCURRENCY=}", flush=True)
+print(f"{REPLAY_RATE_LIMIT=}", flush=True)
+print(f"{REPLAY_MAX_BACKOFF=}", flush=True)
+print(f"{REPLAY_REPORT_INTERVAL=}", flush=True)
+print(f"{REPLAY_SPEEDUP=}", flush=True)
+print(f"{REPLAY_START_DELAY=}", flush=True)
+
+
+def data_file(i: int) -> str:
+    return f"data/filtered/{i}.txt"
+
+
+def _parse_fields(lines: List[bytes]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if not lines:
+        return np.empty(0, dtype=str), np.empty(0, dtype=np.int64), np.empty((0, 2))
+    fields = np.array(b",".join(lines).split(b",")).reshape(-1, 4)
+    ids = fields[:, 0].astype(str)
+    times = fields[:, 1].astype("datetime64[s]")
+    if np.isnat(times).any():
+        # 交给逐行检查剔除
+        raise ValueError("NaT in timestamps")
+    times = times.astype(np.int64)
+    xy = fields[:, 2:].astype(np.float64)
+    return ids, times, xy
+
+
+def _valid_line(line: bytes) -> bool:
+    try:
+        _, t, lng, lat = line.split(b",")
+        float(lng), float(lat)
+        # NaT能被解析，但不是有效的时间
+        return not np.isnat(np.datetime64(t.decode(), "s"))
+    except ValueError:
+        return False
+
+
+def parse_points(buf: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    整个文件一次性解析，每行为id,YYYY-mm-dd HH:MM:SS,lng,lat，返回各点的id、epoch秒与(lng, lat)
+
+    字段数不对的行直接丢弃，不逐行构造对象；时间或经纬度无法解析时才逐行检查，丢弃坏行后再整体解析
+    """
+    lines = buf.splitlines()
+    if any(line.count(b",") != 3 for line in lines):
+        lines = [line for line in lines if line.count(b",") == 3]
+    try:
+        return _parse_fields(lines)
+    except ValueError:
+        return _parse_fields([line for line in lines if _valid_line(line)])
+
+
+def trajectories(ids: np.ndarray, times: np.ndarray, xy: np.ndarray) -> Iterator[Tuple[str, np.ndarray, np.ndarray]]:
+    """
+    按id切分相邻的点，保持文件中的顺序
+    """
+    if len(ids) == 0:
+        return
+    bounds = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(ids)]):
+        yield str(ids[start]), times[start:end], xy[start:end]
+
+
+def shard(files: List[int], workers: int) -> List[List[int]]:
+    """
+    按文件大小贪心分配，各回放进程的数据量大致相同；同一文件只由一个进程发送，轨迹内的顺序不变
+    """
+    shards: List[List[int]] = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for i in sorted(files, key=lambda x: os.path.getsize(data_file(x)), reverse=True):
+        k = sizes.index(min(sizes))
+        shards[k].append(i)
+        sizes[k] += os.path.getsize(data_file(i))
+    return [s for s in shards if s]
+
+
+class WorkerStats:
+    def __init__(self, worker: int):
+        self.worker = worker
+        self.points = 0
+        self.requests = 0
+        self.retries = 0
+        self.dropped_lines = 0
+        self.latencies: List[float] = []
+        # 按事件时间回放时各点实际发送时间与计划时间之差
+        self.lags: List[float] = []
+        self.started = time.perf_counter()
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        lags = np.array(self.lags) if self.lags else np.zeros(1)
+        return {
+            "worker": self.worker,
+            "points": self.points,
+            "requests": self.requests,
+            "retries": self.retries,
+            "dropped_lines": self.dropped_lines,
+            "elapsed": elapsed,
+            "pps": self.points / elapsed if elapsed else 0,
+            "latency_mean": float(latencies.mean()),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "latency_max": float(latencies.max()),
+            "lag_mean": float(lags.mean()),
+            "lag_p50": float(np.percentile(lags, 50)),
+            "lag_p99": float(np.percentile(lags, 99)),
+            "lag_max": float(lags.max())
+        }
+
+
+async def send(proxy, payload: str, stats: WorkerStats, throttler: Optional[Throttler]) -> None:
+    """
+    发送直到assembler接受，失败时按指数退避异步等待，不阻塞同一进程内的其他轨迹
+    """
+    attempt = 0
+    while True:
+        try:
+            if throttler is not None:
+                async with throttler:
+                    pass
+            before = time.perf_counter()
+            accepted = await proxy.AcceptPackedPoints(payload)
+            stats.latencies.append(time.perf_counter() - before)
+            stats.requests += 1
+            if accepted:
+                return
+        except Exception as e:
+            print(f"worker {stats.worker}: {e}", flush=True)
+        attempt += 1
+        stats.retries += 1
+        await asyncio.sleep(min(REPLAY_MAX_BACKOFF, 0.01 * 2 ** attempt) * random.uniform(0.5, 1))
+
+
+async def replay_trajectory(trajectory_id: str, times: np.ndarray, xy: np.ndarray, stats: WorkerStats,
+                            throttler: Optional[Throttler]) -> None:
+    proxy = ActorProxy.create('TrajectoryAssemblerActor', ActorId(trajectory_id), TrajectoryAssemblerInterface)
+    for k in range(0, len(times), INGRESS_BATCH_SIZE):
+        payload = to_wire(encode_trajectory(trajectory_id, xy[k:k + INGRESS_BATCH_SIZE],
+                                            times[k:k + INGRESS_BATCH_SIZE]))
+        await send(proxy, payload, stats, throttler)
+        stats.points += len(times[k:k + INGRESS_BATCH_SIZE])
+
+
+async def replay_event_time(tracks: List[Tuple[str, np.ndarray, np.ndarray]], stats: WorkerStats,
+                            throttler: Optional[Throttler], t0: float, first_event: int, speedup: float) -> None:
+    """
+    每个点计划在t0 + (事件时间 - first_event) / speedup发送，所有轨迹共用一个按计划时间排序的堆
+
+    堆中每条轨迹只放下一个待发送的点，上一批发送完成后才放入下一个，保证轨迹内的顺序；
+    落后于计划时把已到期的连续点合并成一批发送，记录每个点的实际发送时间与计划时间之差
+    """
+    semaphore = asyncio.Semaphore(REPLAY_CONCURRENCY)
+    proxies = [ActorProxy.create('TrajectoryAssemblerActor', ActorId(trajectory_id), TrajectoryAssemblerInterface)
+               for trajectory_id, _, _ in tracks]
+    due = [t0 + (times - first_event) / speedup for _, times, _ in tracks]
+    heap: List[Tuple[float, int, int]] = [(d[0], j, 0) for j, d in enumerate(due) if len(d)]
+    heapq.heapify(heap)
+    wakeup = asyncio.Event()
+    inflight = set()
+    errors: List[BaseException] = []
+
+    async def send_due(j: int, k: int) -> None:
+        trajectory_id, times, xy = tracks[j]
+        async with semaphore:
+            now = time.time()
+            end = min(k + INGRESS_BATCH_SIZE, int(np.searchsorted(due[j], now, side="right")), len(times))
+            end = max(end, k + 1)
+            stats.lags.extend((now - due[j][k:end]).tolist())
+            await send(proxies[j], to_wire(encode_trajectory(trajectory_id, xy[k:end], times[k:end])), stats,
+                       throttler)
+            stats.points += end - k
+        if end < len(times):
+            heapq.heappush(heap, (due[j][end], j, end))
+
+    def finished(task: asyncio.Future) -> None:
+        inflight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+        wakeup.set()
+
+    while (heap or inflight) and not errors:
+        if heap and heap[0][0] <= time.time():
+            _, j, k = heapq.heappop(heap)
+            task = asyncio.ensure_future(send_due(j, k))
+            inflight.add(task)
+            task.add_done_callback(finished)
+            continue
+        # 等到堆顶到期，或有发送完成
+        delay = heap[0][0] - time.time() if heap else None
+        try:
+            await asyncio.wait_for(wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+    if errors:
+        for task in inflight:
+            task.cancel()
+        raise errors[0]
+
+
+def load_tracks(files: List[int], stats: WorkerStats) -> List[Tuple[str, np.ndarray, np.ndarray]]:
+    tracks = []
+    for i in files:
+        with open(data_file(i), "rb") as f:
+            buf = f.read()
+        ids, times, xy = parse_points(buf)
+        stats.dropped_lines += len(buf.splitlines()) - len(ids)
+        tracks.extend(trajectories(ids, times, xy))
+    return tracks
+
+
+def start_time(tracks: List[Tuple[str, np.ndarray, np.ndarray]], barrier, starts) -> Tuple[float, int]:
+    """
+    各回放进程解析完数据后交换各自最早的事件时间与完成时刻，等所有进程都到齐，
+    得到相同的起始时刻t0与全局最早的事件时间，无需由调用方再解析一遍所有文件
+    """
+    first = min((int(times.min()) for _, times, _ in tracks if len(times)), default=None)
+    starts.append((first, time.time()))
+    barrier.wait()
+    firsts = [f for f, _ in starts if f is not None]
+    return max(t for _, t in starts) + REPLAY_START_DELAY, min(firsts, default=0)
+
+
+async def replay_files(worker: int, files: List[int], rate_limit: float, speedup: float = 0,
+                       barrier=None, starts=None) -> dict:
+    stats = WorkerStats(worker)
+    throttler = Throttler(rate_limit=rate_limit, period=1, retry_interval=0.0001) if rate_limit > 0 else None
+    semaphore = asyncio.Semaphore(REPLAY_CONCURRENCY)
+
+    async def run(trajectory_id: str, times: np.ndarray, xy: np.ndarray) -> None:
+        async with semaphore:
+            await replay_trajectory(trajectory_id, times, xy, stats, throttler)
+
+    async def progress() -> None:
+        while True:
+            await asyncio.sleep(REPLAY_REPORT_INTERVAL)
+            r = stats.report()
+            print(f"worker {worker}: {r['points']} p, {r['pps']:.1f} p/s, p99 {r['latency_p99']:.4f}s"
+                  + (f", lag p99 {r['lag_p99']:.4f}s" if speedup > 0 else ""), flush=True)
+
+    try:
+        tracks = load_tracks(files, stats)
+    except Exception:
+        # 不让其他回放进程一直等待本进程
+        if barrier is not None:
+            barrier.abort()
+        raise
+    if speedup > 0:
+        t0, first_event = start_time(tracks, barrier, starts)
+    reporter = asyncio.ensure_future(progress())
+    try:
+        if speedup > 0:
+            await replay_event_time(tracks, stats, throttler, t0, first_event, speedup)
+        else:
+            await asyncio.gather(*[run(*t) for t in tracks])
+    finally:
+        reporter.cancel()
+    return stats.report()
+
+
+def replay_worker(worker: int, files: List[int], rate_limit: float, speedup: float = 0,
+                  barrier=None, starts=None) -> dict:
+    try:
+        return asyncio.run(replay_files(worker, files, rate_limit, speedup, barrier, starts))
+    except Exception:
+        traceback.print_exc()
+        raise
+
+
+def replay(files: List[int], workers: int = REPLAY_WORKERS, speedup: float = REPLAY_SPEEDUP) -> dict:
+    """
+    把轨迹文件分给多个回放进程并发发送，返回各进程与总体的吞吐和延迟
+
+    speedup大于0时按事件时间回放，所有进程以同一时刻对应最早的事件时间，各进程经由manager进程交换起始时间
+    """
+    shards = shard(files, workers)
+    n = len(shards)
+    rate_limit = REPLAY_RATE_LIMIT / n if shards else 0
+    start = time.perf_counter()
+    # spawn避免子进程继承调用方正在运行的事件循环
+    context = multiprocessing.get_context("spawn")
+    with ExitStack() as stack:
+        barrier, starts = None, None
+        if speedup > 0:
+            manager = stack.enter_context(context.Manager())
+            barrier, starts = manager.Barrier(n or 1), manager.list()
+        # 每个分片独占一个进程，按事件时间回放时所有分片同时等待起始时间
+        pool = stack.enter_context(ProcessPoolExecutor(n or 1, mp_context=context))
+        reports = list(pool.map(replay_worker, range(n), shards, [rate_limit] * n, [speedup] * n,
+                                [barrier] * n, [starts] * n))
+    elapsed = time.perf_counter() - start
+    points = sum(r["points"] for r in reports)
+    return {
+        "workers": reports,
+        "points": points,
+        "elapsed": elapsed,
+        "pps": points / elapsed if elapsed else 0,
+        "latency_p99_max": max((r["latency_p99"] for r in reports), default=0),
+        "speedup": speedup,
+        "lag_p99_max": max((r["lag_p99"] for r in reports), default=0)
+    }
+
+
+if __name__ == "__main__":
+    res = replay(para["trajectories"])
+    for r in res["workers"]:
+        print(r, flush=True)
+    print(f"replayed {res['points']} points in {res['elapsed']:.2f}s, {res['pps']:.1f} p/s"
+          + (f", x{res['speedup']} lag p99 {res['lag_p99_max']:.4f}s" if res["speedup"] > 0 else ""), flush=True)
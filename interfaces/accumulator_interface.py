@@ -12,6 +12,10 @@ class AccumulatorInterface(ActorInterface):
     async def meta_add(self):
         ...
 
+    @actormethod(name="MetaAddMany")
+    async def meta_add_many(self, n: int):
+        ...
+
     @actormethod(name="Get")
     async def get(self) -> Dict[str, int]:
         ...
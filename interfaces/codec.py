@@ -0,0 +1,134 @@
+import struct
+from typing import List, Tuple, Union
+
+import numpy as np
+from dacite import from_dict, Config
+
+from interfaces.packed import to_wire, from_wire
+from interfaces.types import TrajectoryPoint, TrajectorySegment
+
+# 打包格式，均为小端序：
+#   头部：格式版本(u1)、记录数n(u4)、轨迹id数k(u4)
+#   id表：k个u2的utf-8字节长度，随后是各id的utf-8字节
+#   点：n个u4的id序号，n个(lng, lat)交错f8，n个i8的epoch秒
+#   线段：3列n个u4的id序号(线段、起点、终点)，起点与终点各按点的格式存放坐标与时间
+VERSION = 1
+HEADER = struct.Struct("<BII")
+ID_DTYPE = np.dtype("<u4")
+ID_LENGTH_DTYPE = np.dtype("<u2")
+XY_DTYPE = np.dtype("<f8")
+TIME_DTYPE = np.dtype("<i8")
+# 旧版字典中的时间为datetime，由TrajectoryPoint自行转换为epoch秒
+LEGACY = Config(check_types=False)
+
+
+def _intern(ids: List[str]) -> Tuple[List[str], np.ndarray]:
+    """
+    相同的轨迹id只存一次，返回id表与每条记录的序号
+    """
+    table: dict = {}
+    index = np.fromiter((table.setdefault(i, len(table)) for i in ids), dtype=ID_DTYPE, count=len(ids))
+    return list(table), index
+
+
+def _encode_ids(table: List[str]) -> bytes:
+    encoded = [i.encode("utf-8") for i in table]
+    return np.array([len(e) for e in encoded], dtype=ID_LENGTH_DTYPE).tobytes() + b"".join(encoded)
+
+
+def _decode_ids(buf: memoryview, offset: int, k: int) -> Tuple[List[str], int]:
+    lengths = np.frombuffer(buf, dtype=ID_LENGTH_DTYPE, count=k, offset=offset).tolist()
+    offset += k * ID_LENGTH_DTYPE.itemsize
+    table = []
+    for n in lengths:
+        table.append(str(buf[offset:offset + n], "utf-8"))
+        offset += n
+    return table, offset
+
+
+def _encode_columns(points: List[TrajectoryPoint]) -> bytes:
+    xy = np.array([(p.lng, p.lat) for p in points], dtype=XY_DTYPE).reshape(-1, 2)
+    time = np.fromiter((p.time for p in points), dtype=TIME_DTYPE, count=len(points))
+    return xy.tobytes() + time.tobytes()
+
+
+def _decode_columns(buf: memoryview, offset: int, n: int) -> Tuple[list, list, list, int]:
+    xy = np.frombuffer(buf, dtype=XY_DTYPE, count=2 * n, offset=offset).reshape(n, 2)
+    offset += 2 * n * XY_DTYPE.itemsize
+    time = np.frombuffer(buf, dtype=TIME_DTYPE, count=n, offset=offset)
+    offset += n * TIME_DTYPE.itemsize
+    return xy[:, 0].tolist(), xy[:, 1].tolist(), time.tolist(), offset
+
+
+def encode_points(points: List[TrajectoryPoint]) -> bytes:
+    table, index = _intern([p.id for p in points])
+    return (HEADER.pack(VERSION, len(points), len(table)) + _encode_ids(table)
+            + index.tobytes() + _encode_columns(points))
+
+
+def decode_points(data: bytes) -> List[TrajectoryPoint]:
+    buf = memoryview(data)
+    version, n, k = HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError(f"Unsupported codec version {version}")
+    table, offset = _decode_ids(buf, HEADER.size, k)
+    index = np.frombuffer(buf, dtype=ID_DTYPE, count=n, offset=offset).tolist()
+    lngs, lats, times, _ = _decode_columns(buf, offset + n * ID_DTYPE.itemsize, n)
+    return [TrajectoryPoint(table[i], t, lng, lat) for i, t, lng, lat in zip(index, times, lngs, lats)]
+
+
+def encode_trajectory(trajectory_id: str, xy: np.ndarray, time: np.ndarray) -> bytes:
+    """
+    同一轨迹的点直接由数组打包，与encode_points格式相同，无需逐点构造对象
+    """
+    n = len(time)
+    return (HEADER.pack(VERSION, n, 1) + _encode_ids([trajectory_id]) + np.zeros(n, dtype=ID_DTYPE).tobytes()
+            + xy.astype(XY_DTYPE, copy=False).tobytes() + time.astype(TIME_DTYPE, copy=False).tobytes())
+
+
+def encode_segments(segments: List[TrajectorySegment]) -> bytes:
+    n = len(segments)
+    table, index = _intern([s.id for s in segments] + [s.start.id for s in segments] + [s.end.id for s in segments])
+    return (HEADER.pack(VERSION, n, len(table)) + _encode_ids(table) + index.tobytes()
+            + _encode_columns([s.start for s in segments]) + _encode_columns([s.end for s in segments]))
+
+
+def decode_segments(data: bytes) -> List[TrajectorySegment]:
+    buf = memoryview(data)
+    version, n, k = HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError(f"Unsupported codec version {version}")
+    table, offset = _decode_ids(buf, HEADER.size, k)
+    index = np.frombuffer(buf, dtype=ID_DTYPE, count=3 * n, offset=offset).tolist()
+    start_lngs, start_lats, start_times, offset = _decode_columns(buf, offset + 3 * n * ID_DTYPE.itemsize, n)
+    end_lngs, end_lats, end_times, _ = _decode_columns(buf, offset, n)
+    return [TrajectorySegment(table[index[j]],
+                              TrajectoryPoint(table[index[n + j]], start_times[j], start_lngs[j], start_lats[j]),
+                              TrajectoryPoint(table[index[2 * n + j]], end_times[j], end_lngs[j], end_lats[j]))
+            for j in range(n)]
+
+
+def points_to_wire(points: List[TrajectoryPoint]) -> str:
+    return to_wire(encode_points(points))
+
+
+def points_from_wire(data: Union[str, List[dict]]) -> List[TrajectoryPoint]:
+    """
+    同时接受旧版按字段存放的字典列表
+    """
+    if isinstance(data, str):
+        return decode_points(from_wire(data))
+    return [from_dict(TrajectoryPoint, x, LEGACY) for x in data]
+
+
+def segments_to_wire(segments: List[TrajectorySegment]) -> str:
+    return to_wire(encode_segments(segments))
+
+
+def segments_from_wire(data: Union[str, List[dict]]) -> List[TrajectorySegment]:
+    """
+    同时接受旧版按字段存放的字典列表
+    """
+    if isinstance(data, str):
+        return decode_segments(from_wire(data))
+    return [from_dict(TrajectorySegment, x, LEGACY) for x in data]
@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 from dapr.actor import ActorInterface, actormethod
 
@@ -8,13 +8,33 @@ class DistributedIndexInterface(ActorInterface):
     async def accept_new_segment(self, segment: dict) -> Tuple[bool, int]:
         ...
 
+    @actormethod(name="AcceptPackedSegment")
+    async def accept_packed_segment(self, data: str) -> Tuple[bool, int]:
+        ...
+
     @actormethod(name="InitializeAsANewChildRegion")
     async def initialize_as_a_new_child_region(self, segments: List[dict]) -> bool:
         ...
 
+    @actormethod(name="InitializeWithPackedSegments")
+    async def initialize_with_packed_segments(self, data: str) -> bool:
+        ...
+
     @actormethod(name="Query")
     async def query(self, wkt_string: str) -> List[int]:
         ...
 
+    @actormethod(name="QueryWithCounts")
+    async def query_with_counts(self, wkt_string: str) -> Tuple[bool, Dict[str, int]]:
+        ...
+
+    @actormethod(name="Subscribe")
+    async def subscribe(self, data: dict) -> bool:
+        ...
+
+    @actormethod(name="Unsubscribe")
+    async def unsubscribe(self, query: str) -> bool:
+        ...
+
     async def split(self) -> None:
         ...
@@ -12,6 +12,10 @@ class IndexMetaInterface(ActorInterface):
     async def query(self, data: dict) -> List[str]:
         ...
 
+    @actormethod(name="QueryMany")
+    async def query_many(self, data: dict) -> dict:
+        ...
+
     @actormethod(name="AgentQuery")
     async def agent_query(self, wkt: str) -> List[str]:
         ...
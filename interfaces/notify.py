@@ -0,0 +1,72 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set
+
+from dapr.actor import ActorProxy, ActorId
+
+from interfaces.distributed_index_interface import DistributedIndexInterface
+from interfaces.standing_query_interface import StandingQueryInterface
+
+with open("tests/parameters.json") as f:
+    para: dict = json.load(f)
+    # 同一进程内合并发往持续查询的变化通知的间隔（秒）
+    STANDING_QUERY_NOTIFY_INTERVAL = para.get("STANDING_QUERY_NOTIFY_INTERVAL", 1)
+
+print(f"{STANDING_QUERY_NOTIFY_INTERVAL=}", flush=True)
+
+# 持续查询id -> 上次发送之后发生变化的轨迹
+_pending: Dict[str, Set[str]] = defaultdict(set)
+# 持续查询id -> 分裂后转交了订阅的子分区
+_regions: Dict[str, Set[str]] = defaultdict(set)
+_flusher: Optional[asyncio.Future] = None
+
+
+def notify_standing_queries(queries: Iterable[str], trajectories: Iterable[str], regions: Iterable[str] = ()) -> None:
+    """
+    记下这些轨迹发生了变化，由后台任务定时合并后发给各持续查询，不阻塞数据写入。
+    regions为分裂后新订阅的子分区，由持续查询记下以便之后退订
+    """
+    global _flusher
+    for q in queries:
+        _pending[q].update(trajectories)
+        _regions[q].update(regions)
+    if _pending and _flusher is None:
+        # 延迟创建，保证绑定到服务实际运行的事件循环
+        _flusher = asyncio.ensure_future(_flush_loop())
+
+
+async def flush() -> None:
+    """
+    每个持续查询只发一次通知，带上期间所有变化的轨迹
+    """
+    global _pending, _regions
+    pending, _pending = _pending, defaultdict(set)
+    regions, _regions = _regions, defaultdict(set)
+    queries = list(pending)
+    results = await asyncio.gather(*[
+        ActorProxy.create('StandingQueryActor', ActorId(q), StandingQueryInterface).Notify(
+            {"trajectories": list(pending[q]), "regions": list(regions.get(q, ()))}) for q in queries],
+        return_exceptions=True)
+    stale = []
+    for q, res in zip(queries, results):
+        if isinstance(res, Exception):
+            # 持续查询重新激活时会整体刷新，丢失的通知不影响结果
+            print(f"notify {q} failed:", res, flush=True)
+            if regions.get(q):
+                # 子分区没有送达则查询无法退订它们，下一次重试
+                _pending[q].update(pending[q])
+                _regions[q].update(regions[q])
+        elif res is False:
+            # 查询已注销，退订通知途中转交出去的子分区
+            stale.extend((q, r) for r in regions.get(q, ()))
+    await asyncio.gather(*[
+        ActorProxy.create('DistributedIndexActor', ActorId(r), DistributedIndexInterface).Unsubscribe(q)
+        for q, r in stale], return_exceptions=True)
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(STANDING_QUERY_NOTIFY_INTERVAL)
+        if _pending:
+            await flush()
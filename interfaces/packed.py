@@ -0,0 +1,36 @@
+import base64
+from typing import Tuple
+
+import numpy as np
+
+# 打包格式：n个点的(lng, lat)交错float64，随后是n个int64的epoch秒，均为小端序
+POINT_BYTES = 3 * 8
+XY_DTYPE = np.dtype("<f8")
+TIME_DTYPE = np.dtype("<i8")
+
+
+def to_wire(buf: bytes) -> str:
+    """
+    bytes转为可JSON传输的字符串，加前缀避免被DaprJSONDecoder误识别为日期
+    """
+    return "b" + base64.b64encode(buf).decode("ascii")
+
+
+def from_wire(s: str) -> bytes:
+    return base64.b64decode(s[1:])
+
+
+def pack_trajectory(xy: np.ndarray, time: np.ndarray) -> bytes:
+    return xy.astype(XY_DTYPE, copy=False).tobytes() + time.astype(TIME_DTYPE, copy=False).tobytes()
+
+
+def unpack_trajectory(buf: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    返回(n, 2)的经纬度数组和n个epoch秒，直接引用缓冲区而不逐点构造对象
+    """
+    n = len(buf) // POINT_BYTES
+    # bytearray保证数组可写，traj_dist等扩展不接受只读缓冲区
+    data = bytearray(buf)
+    xy = np.frombuffer(data, dtype=XY_DTYPE, count=2 * n).reshape(n, 2)
+    time = np.frombuffer(data, dtype=TIME_DTYPE, count=n, offset=2 * n * XY_DTYPE.itemsize)
+    return xy, time
@@ -0,0 +1,19 @@
+from dapr.actor import ActorInterface, actormethod
+
+
+class StandingQueryInterface(ActorInterface):
+    @actormethod(name="Register")
+    async def register(self, data: dict) -> bool:
+        ...
+
+    @actormethod(name="Unregister")
+    async def unregister(self) -> bool:
+        ...
+
+    @actormethod(name="Notify")
+    async def notify(self, data: dict) -> bool:
+        ...
+
+    @actormethod(name="Result")
+    async def result(self) -> dict:
+        ...
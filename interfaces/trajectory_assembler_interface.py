@@ -8,6 +8,30 @@ class TrajectoryAssemblerInterface(ActorInterface):
     async def accept_new_point(self, p: dict) -> bool:
         ...
 
+    @actormethod(name="AcceptNewPoints")
+    async def accept_new_points(self, points: List[dict]) -> bool:
+        ...
+
+    @actormethod(name="AcceptPackedPoints")
+    async def accept_packed_points(self, data: str) -> bool:
+        ...
+
     @actormethod(name="Query")
     async def query(self) -> List[dict]:
         ...
+
+    @actormethod(name="QueryPacked")
+    async def query_packed(self) -> str:
+        ...
+
+    @actormethod(name="QueryPackedFrom")
+    async def query_packed_from(self, offset: int) -> dict:
+        ...
+
+    @actormethod(name="Length")
+    async def length(self) -> int:
+        ...
+
+    @actormethod(name="Watch")
+    async def watch(self, data: dict) -> bool:
+        ...
@@ -1,18 +1,68 @@
 import datetime
+import sys
 from dataclasses import dataclass
-from math import inf
+from typing import Union
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_epoch(t: Union[datetime.datetime, int]) -> int:
+    """
+    datetime转为epoch秒，无时区的时间按UTC处理
+    """
+    if not isinstance(t, datetime.datetime):
+        return int(t)
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return int((t - EPOCH).total_seconds())
+
+
+def from_epoch(e: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(seconds=int(e))
 
 
 @dataclass(eq=True, frozen=True)
 class TrajectoryPoint:
-    id: str = ""
-    time: datetime.datetime = datetime.datetime.now()
-    lng: float = inf
-    lat: float = inf
+    """
+    time为epoch秒，构造时也接受datetime；轨迹id经过驻留，同一轨迹的点共用一个字符串
+    """
+    __slots__ = ("id", "time", "lng", "lat", "_hash")
+    id: str
+    time: int
+    lng: float
+    lat: float
+
+    def __post_init__(self):
+        object.__setattr__(self, "id", sys.intern(self.id))
+        object.__setattr__(self, "time", to_epoch(self.time))
+        object.__setattr__(self, "_hash", hash((self.id, self.time, self.lng, self.lat)))
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self):
+        return self.__class__, (self.id, self.time, self.lng, self.lat)
+
+    def to_datetime(self) -> datetime.datetime:
+        return from_epoch(self.time)
 
 
 @dataclass(eq=True, frozen=True)
 class TrajectorySegment:
-    id: str = ""
-    start: TrajectoryPoint = None
-    end: TrajectoryPoint = None
+    """
+    哈希在构造时算好，放入集合或作为字典键时不再逐层计算
+    """
+    __slots__ = ("id", "start", "end", "_hash")
+    id: str
+    start: TrajectoryPoint
+    end: TrajectoryPoint
+
+    def __post_init__(self):
+        object.__setattr__(self, "id", sys.intern(self.id))
+        object.__setattr__(self, "_hash", hash((self.id, self.start, self.end)))
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self):
+        return self.__class__, (self.id, self.start, self.end)
@@ -59,9 +59,12 @@ for i in {1..30}; do
   echo $! >>pid
 done
 
-# start coordinator
-dapr run --app-id index-meta --app-port 3301 -- hypercorn --bind "0.0.0.0:3301" index_meta.main:app >"logs/index-meta.log" 2>&1 &
-echo $! >>pid
+# start coordinator, shard actors are spread over the replicas by dapr placement
+for i in {1..5}; do
+  let p=3400+$i
+  dapr run --app-id index-meta --app-port "$p" -- hypercorn --bind "0.0.0.0:$p" index_meta.main:app >"logs/index-meta$i.log" 2>&1 &
+  echo $! >>pid
+done
 
 # start executor
 for i in {1..5}; do
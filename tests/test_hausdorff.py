@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from compute.kernel import hausdorff, hausdorff_many, pack_candidates
+
+tdist = pytest.importorskip("traj_dist.distance")
+
+TILE_SIZES = [1, 7, 1 << 20]
+
+
+def walk(rng: np.random.Generator, n: int, lng: float = 116.3, lat: float = 39.9) -> np.ndarray:
+    return np.cumsum(rng.uniform(-1e-3, 1e-3, (n, 2)), axis=0) + [lng, lat]
+
+
+def cases():
+    """
+    目标与若干候选，候选包括单点轨迹、两点轨迹与目标自身
+    """
+    rng = np.random.default_rng(2)
+    res = []
+    for trial in range(20):
+        target = walk(rng, int(rng.integers(1, 30)))
+        candidates = [walk(rng, int(rng.choice([1, 2, rng.integers(1, 40)])), 116.3 + rng.uniform(0, 0.01))
+                      for _ in range(int(rng.integers(1, 8)))]
+        candidates.append(target.copy())
+        res.append((target, candidates))
+    return res
+
+
+def reference(target: np.ndarray, candidates: list) -> np.ndarray:
+    return np.array([tdist.hausdorff(target, c, "spherical") for c in candidates])
+
+
+@pytest.mark.parametrize("tile_size", TILE_SIZES)
+def test_hausdorff_many_matches_traj_dist(tile_size):
+    for target, candidates in cases():
+        points, offsets = pack_candidates(candidates)
+        got = hausdorff_many(target, points, offsets, tile_size=tile_size)
+        np.testing.assert_allclose(got, reference(target, candidates), rtol=1e-12, atol=1e-9)
+
+
+@pytest.mark.parametrize("tile_size", TILE_SIZES)
+def test_hausdorff_matches_traj_dist(tile_size):
+    for target, candidates in cases():
+        got = [hausdorff(target, c, tile_size=tile_size) for c in candidates]
+        np.testing.assert_allclose(got, reference(target, candidates), rtol=1e-12, atol=1e-9)
+
+
+def test_single_point_trajectories():
+    rng = np.random.default_rng(3)
+    target = walk(rng, 1)
+    candidates = [walk(rng, 1, 116.31), walk(rng, 5, 116.29), target.copy()]
+    points, offsets = pack_candidates(candidates)
+    expected = reference(target, candidates)
+    np.testing.assert_allclose(hausdorff_many(target, points, offsets), expected, rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose([hausdorff(target, c) for c in candidates], expected, rtol=1e-12, atol=1e-9)
+
+
+@pytest.mark.parametrize("tile_size", TILE_SIZES)
+def test_threshold_pruning(tile_size):
+    """
+    未超过阈值的结果精确，超过阈值的结果是一个大于阈值的下界
+    """
+    for target, candidates in cases():
+        expected = reference(target, candidates)
+        # 阈值取在两个相邻结果之间，避免与某个结果恰好相等
+        distinct = np.unique(expected)
+        if len(distinct) < 2:
+            continue
+        k = len(distinct) // 2
+        threshold = float(distinct[k - 1] + distinct[k]) / 2
+        points, offsets = pack_candidates(candidates)
+        for got in (hausdorff_many(target, points, offsets, threshold=threshold, tile_size=tile_size),
+                    np.array([hausdorff(target, c, threshold=threshold, tile_size=tile_size) for c in candidates])):
+            kept = expected <= threshold
+            np.testing.assert_array_equal(got <= threshold, kept)
+            np.testing.assert_allclose(got[kept], expected[kept], rtol=1e-12, atol=1e-9)
+            assert (got[~kept] <= expected[~kept] + 1e-9).all()
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("asyncio_throttle")
+
+from ingress import replay  # noqa: E402
+
+GOOD = b"1,2008-02-02 15:36:08,116.51172,39.92123\n1,2008-02-02 15:46:08,116.51135,39.93883\n"
+BAD = b"1,2008-02-0x 15:36:08,116.51172,39.92123\n1,2008-02-02 15:46:08,abc,39.93883\n1,NaT,116.5,39.9\n1,2008\n"
+
+
+@pytest.fixture
+def data_files(tmp_path, monkeypatch):
+    files = {1: GOOD, 2: b"", 3: BAD, 4: BAD + GOOD}
+    for i, buf in files.items():
+        (tmp_path / f"{i}.txt").write_bytes(buf)
+    monkeypatch.setattr(replay, "data_file", lambda i: str(tmp_path / f"{i}.txt"))
+    return files
+
+
+def test_parse_points_drops_bad_lines():
+    ids, times, xy = replay.parse_points(BAD + GOOD)
+    expected = replay.parse_points(GOOD)
+    assert ids.tolist() == ["1", "1"]
+    np.testing.assert_array_equal(times, expected[1])
+    np.testing.assert_array_equal(xy, expected[2])
+
+
+def test_parse_points_rejects_nat():
+    ids, times, _ = replay.parse_points(b"1,NaT,116.5,39.9\n" + GOOD)
+    assert len(ids) == 2 and (times > 0).all()
+
+
+@pytest.mark.parametrize("buf", [b"", BAD])
+def test_no_valid_lines(buf):
+    ids, times, xy = replay.parse_points(buf)
+    assert len(ids) == len(times) == len(xy) == 0
+    assert list(replay.trajectories(ids, times, xy)) == []
+
+
+def test_load_tracks_skips_empty_and_invalid_files(data_files):
+    stats = replay.WorkerStats(0)
+    tracks = replay.load_tracks([1, 2, 3, 4], stats)
+    assert [(t, len(times)) for t, times, _ in tracks] == [("1", 2), ("1", 2)]
+    assert stats.dropped_lines == 2 * len(BAD.splitlines())
@@ -0,0 +1,126 @@
+import asyncio
+import types
+
+import pytest
+from dapr.actor import ActorId
+from dapr.serializers import DefaultJSONSerializer
+
+import agent.standing as standing
+import index.actor as index
+import interfaces.notify as notify
+from interfaces.distributed_index_interface import DistributedIndexInterface
+from interfaces.standing_query_interface import StandingQueryInterface
+
+PARENT = "872830828ffffff"
+AREA = "POLYGON ((0 0, 1 0, 1 1, 0 0))"
+
+
+class MemoryState:
+    def __init__(self):
+        self.store = {}
+
+    async def try_get_state(self, k):
+        return k in self.store, self.store.get(k)
+
+    async def set_state(self, k, v):
+        self.store[k] = v
+
+    async def remove_state(self, k):
+        self.store.pop(k, None)
+
+
+class SilentLogger:
+    def __getattr__(self, level):
+        async def log(*args, **kwargs):
+            pass
+
+        return log
+
+
+class Cluster:
+    """
+    进程内的actor注册表，代理按接口上的方法名调用对应的actor
+    """
+
+    def __init__(self):
+        self.actors = {}
+        self.methods = {t: {getattr(f, "__actormethod__"): name for name, f in vars(i).items()
+                            if hasattr(f, "__actormethod__")}
+                        for t, i in [("StandingQueryActor", StandingQueryInterface),
+                                     ("DistributedIndexActor", DistributedIndexInterface)]}
+
+    def actor(self, actor_type: str, actor_id: str):
+        if (actor_type, actor_id) not in self.actors:
+            cls = standing.StandingQueryActor if actor_type == "StandingQueryActor" else index.DistributedIndexActor
+            ctx = types.SimpleNamespace(actor_type_info=types.SimpleNamespace(type_name=actor_type),
+                                        message_serializer=DefaultJSONSerializer())
+            a = cls(ctx, ActorId(actor_id))
+            a._state_manager = MemoryState()
+            a.logger = SilentLogger()
+            self.actors[actor_type, actor_id] = a
+        return self.actors[actor_type, actor_id]
+
+    def create(self, actor_type: str, actor_id: ActorId, _):
+        cluster = self
+
+        class Proxy:
+            def __getattr__(self, method):
+                return getattr(cluster.actor(actor_type, actor_id.id), cluster.methods[actor_type][method])
+
+        return Proxy()
+
+    def subscribed(self, query: str):
+        return {k[1] for k, a in self.actors.items() if k[0] == "DistributedIndexActor" and query in a.subscriptions}
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    c = Cluster()
+    for m in (standing, index, notify):
+        monkeypatch.setattr(m, "ActorProxy", types.SimpleNamespace(create=c.create))
+    # 不启动后台发送，由测试显式flush
+    monkeypatch.setattr(notify, "_flusher", object())
+    monkeypatch.setattr(index.DistributedIndexActor, "_childbirth", staticmethod(lambda h, payload: asyncio.sleep(0, True)))
+
+    async def no_timer(*args):
+        pass
+
+    monkeypatch.setattr(standing.StandingQueryActor, "register_timer", no_timer)
+    monkeypatch.setattr(standing.StandingQueryActor, "unregister_timer", no_timer)
+    return c
+
+
+async def register_and_split(cluster: Cluster):
+    query = cluster.actor("StandingQueryActor", "q")
+    await query.register({"target_trajectory_id": "t", "threshold": 1})
+    await query._subscribe({PARENT}, AREA)
+    parent = cluster.actor("DistributedIndexActor", PARENT)
+    children = parent.split_h3_area(PARENT, parent.resolution + 1)
+    await parent._give_birth({next(iter(children)): []})
+    assert cluster.subscribed("q") == children | {PARENT}
+    return query, children
+
+
+def test_unregister_after_split(cluster):
+    async def run():
+        query, children = await register_and_split(cluster)
+        await notify.flush()
+        assert query.regions == children | {PARENT}
+        await query.unregister()
+        assert cluster.subscribed("q") == set()
+
+    asyncio.run(run())
+
+
+def test_unregister_before_regions_reported(cluster):
+    """
+    子分区的通知送达前查询已注销，由通知的发送方退订
+    """
+    async def run():
+        query, children = await register_and_split(cluster)
+        await query.unregister()
+        assert cluster.subscribed("q") == children
+        await notify.flush()
+        assert cluster.subscribed("q") == set()
+
+    asyncio.run(run())